@@ -1,40 +1,1451 @@
-import tkinter as tk
-from tkinter import scrolledtext
+try:
+    import tkinter as tk
+    from tkinter import scrolledtext
+except ImportError:
+    tk = None
 import re
 from datetime import datetime
 import os
+import sys
+import getpass
+import time
+import cProfile
+import functools
+import itertools
+import bisect
 import zipfile
+import zlib
+import struct
+import mmap
+import hashlib
+import fnmatch
+import multiprocessing
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import argparse
+import asyncio
+import json
+import io
+import queue
+import threading
+from contextlib import contextmanager, redirect_stdout
 from pathlib import Path
-import base64
+from collections import OrderedDict, deque, namedtuple
+from collections.abc import MutableMapping
+
+class DirNode:
+    # labels - отсортированные имена для вывода ("dir/" для директорий),
+    # строятся при первом листинге и дальше поддерживаются add/remove.
+    # Список не меняется на месте, а заменяется новым: выданный листинг остается снимком.
+    # size и files - объем и число файлов во всем поддереве, их поддерживает VFS._account
+    __slots__ = ("name", "parent", "children", "labels", "size", "files")
+
+    def __init__(self, name="", parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = {}
+        self.labels = None
+        self.size = 0
+        self.files = 0
+
+    def is_dir(self):
+        return True
+
+    def add(self, name, child):
+        labels = self.labels
+        if labels is not None and name not in self.children:
+            label = name + "/" if child.is_dir() else name
+            index = bisect.bisect(labels, label)
+            self.labels = labels[:index] + [label] + labels[index:]
+        self.children[name] = child
+        return child
+
+    def remove(self, name):
+        child = self.children.pop(name)
+        labels = self.labels
+        if labels is not None:
+            index = bisect.bisect_left(labels, name + "/" if child.is_dir() else name)
+            self.labels = labels[:index] + labels[index + 1:]
+        return child
+
+    def sorted_labels(self):
+        if self.labels is None:
+            self.labels = sorted(name + "/" if child.is_dir() else name
+                                 for name, child in self.children.items())
+        return self.labels
+
+    def child_by_label(self, label):
+        return self.children[label[:-1] if label.endswith("/") else label]
+
+
+class OverlayDirNode(DirNode):
+    # Директория overlay-VFS поверх нижних слоев (lowers - директории с тем же путем в слоях,
+    # верхний первым). Пока owner задан, содержимое не перенесено: оно собирается из слоев
+    # при первом обращении к children. lowers остаются для сравнения при экспорте дельты
+    __slots__ = ("_children", "owner", "lowers")
+
+    def __init__(self, name, parent, owner, lowers):
+        super().__init__(name, parent)
+        self.owner = owner
+        self.lowers = lowers
+
+    @property
+    def children(self):
+        if self.owner is not None:
+            self.owner._materialize(self)
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        self._children = value
+
+
+def merge_layers(dirs):
+    # Имя -> FileNode верхнего слоя, где имя есть, или список директорий слоев для объединения.
+    # Файл и whiteout (".wh.имя") скрывают имя в слоях ниже, метка OPAQUE_MARKER - всю директорию
+    entries = {}
+    hidden = set()
+    for lower in dirs:
+        children = lower.children
+        for name, child in children.items():
+            if name.startswith(WHITEOUT_PREFIX) or name in hidden:
+                continue
+            if child.is_dir():
+                stack = entries.get(name)
+                if stack is None:
+                    entries[name] = [child]
+                elif isinstance(stack, list):
+                    stack.append(child)
+            elif name not in entries:
+                entries[name] = child
+        for name, child in children.items():
+            if name.startswith(WHITEOUT_PREFIX):
+                hidden.add(name[len(WHITEOUT_PREFIX):])
+            elif not child.is_dir():
+                hidden.add(name)
+        if OPAQUE_MARKER in children:
+            break
+    return entries
+
+
+class FileNode:
+    # blob - разделяемое содержимое из BlobStore (копии файлов ссылаются на один blob);
+    # origin - неизмененный член исходного архива; None означает, что файл изменен
+    __slots__ = ("name", "parent", "blob", "origin")
+
+    def __init__(self, name, parent, blob, origin=None):
+        self.name = name
+        self.parent = parent
+        self.blob = blob
+        self.origin = origin
+
+    @property
+    def content(self):
+        return self.blob.content
+
+    def is_dir(self):
+        return False
+
+
+# Метки удаления в архивах слоев, как в OCI-образах
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_MARKER = ".wh..wh..opq"
+
+
+def split_path(path):
+    return [part for part in path.split("/") if part]
+
+
+def decode_content(data):
+    # Текстовые файлы хранятся как str, двоичные - как bytes без перекодирования
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data
+
+
+class ZipMemberSource:
+    # Ссылка на член ZIP-архива, который еще не был распакован.
+    __slots__ = ("zip_ref", "info")
+
+    def __init__(self, zip_ref, info):
+        self.zip_ref = zip_ref
+        self.info = info
+
+    @property
+    def size(self):
+        return self.info.file_size
+
+    def read(self):
+        return self.zip_ref.read(self.info)
+
+
+class MappedSource:
+    # Содержимое файла - участок отображенного в память файла, читается без копирования
+    __slots__ = ("mapped", "offset", "size")
+
+    def __init__(self, mapped, offset, size):
+        self.mapped = mapped
+        self.offset = offset
+        self.size = size
+
+    def start(self):
+        return self.offset
+
+    def read(self):
+        start = self.start()
+        return memoryview(self.mapped)[start:start + self.size]
+
+
+class MappedMemberSource(MappedSource):
+    # Несжатый (STORED) член ZIP-архива; смещение данных читается из локального
+    # заголовка при первом обращении
+    __slots__ = ("info",)
+
+    def __init__(self, mapped, info):
+        super().__init__(mapped, None, info.file_size)
+        self.info = info
+
+    def start(self):
+        if self.offset is None:
+            name_len, extra_len = struct.unpack_from("<HH", self.mapped, self.info.header_offset + 26)
+            self.offset = self.info.header_offset + zipfile.sizeFileHeader + name_len + extra_len
+        return self.offset
+
+
+# Формат снимка VFS: заголовок, таблица записей (родитель, blob) в порядке обхода,
+# таблица blob'ов (смещение, размер), имена через NUL и непрерывная область данных
+SNAPSHOT_MAGIC = b"VFSSNAP1"
+SNAPSHOT_EXT = ".vfsnap"
+SNAPSHOT_HEADER = struct.Struct("<8sIIQQ")
+SNAPSHOT_ENTRY = struct.Struct("<II")
+SNAPSHOT_BLOB = struct.Struct("<QQ")
+SNAPSHOT_NO_INDEX = 0xFFFFFFFF
+
+
+def is_snapshot(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def decode_line(data):
+    try:
+        return str(data, 'utf-8')
+    except UnicodeDecodeError:
+        return str(data, 'latin-1')
+
+
+def decode_latin1(data):
+    return str(data, 'latin-1')
+
+
+def scan_lines(buf, view, sep, start, end, decode):
+    # Строки буфера в прямом порядке (как split(sep)), buf используется для поиска,
+    # view - для срезов без копирования всего содержимого
+    while True:
+        pos = buf.find(sep, start, end)
+        if pos < 0:
+            yield decode(view[start:end])
+            return
+        yield decode(view[start:pos])
+        start = pos + 1
+
+
+def scan_lines_reversed(buf, view, sep, start, end, decode):
+    while True:
+        pos = buf.rfind(sep, start, end)
+        if pos < 0:
+            yield decode(view[start:end])
+            return
+        yield decode(view[pos + 1:end])
+        end = pos
+
+
+def member_data_offset(fp, info):
+    fp.seek(info.header_offset)
+    header = fp.read(zipfile.sizeFileHeader)
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_len + extra_len
+
+
+def read_raw_member(zip_ref, info):
+    # Сжатые данные члена архива без распаковки
+    with zip_ref._lock:
+        fp = zip_ref.fp
+        fp.seek(member_data_offset(fp, info))
+        return fp.read(info.compress_size)
+
+
+def write_raw_member(zipf, zinfo, raw):
+    # Запись уже сжатых данных: CRC и размеры должны быть заполнены в zinfo
+    zipf._writecheck(zinfo)
+    zipf._didModify = True
+    zinfo.header_offset = zipf.fp.tell()
+    zipf.fp.write(zinfo.FileHeader())
+    zipf.fp.write(raw)
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+    zipf.start_dir = zipf.fp.tell()
+
+
+def compress_member(data, compresslevel):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if compresslevel == 0:
+        return zipfile.ZIP_STORED, zlib.crc32(data), len(data), data
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    raw = compressor.compress(data) + compressor.flush()
+    return zipfile.ZIP_DEFLATED, zlib.crc32(data), len(data), raw
+
+
+class Blob:
+    __slots__ = ("key", "content", "size", "refs")
+
+    def __init__(self, key, content, size):
+        self.key = key
+        self.content = content
+        self.size = size
+        self.refs = 0
+
+
+class BlobStore:
+    # Содержимое файлов по хэшу со счетчиком ссылок. Blob никогда не изменяется:
+    # запись в файл создает новый blob, поэтому копии разделяют данные до изменения.
+    def __init__(self):
+        self.blobs = {}
+        self.size = 0
+        self.resident = 0
+
+    def put(self, content):
+        if isinstance(content, (ZipMemberSource, MappedSource)):
+            # Ленивое содержимое не читается ради хэша, ключ - сам источник
+            key, size = content, content.size
+        else:
+            data = content.encode('utf-8') if isinstance(content, str) else content
+            key = (isinstance(content, str), hashlib.blake2b(data, digest_size=16).digest())
+            size = len(data)
+        blob = self.blobs.get(key)
+        if blob is None:
+            blob = self._add(Blob(key, content, size))
+        blob.refs += 1
+        return blob
+
+    def _add(self, blob):
+        # Объем различного содержимого и та его часть, что хранится в памяти, а не в архиве
+        self.blobs[blob.key] = blob
+        self.size += blob.size
+        if not isinstance(blob.content, (ZipMemberSource, MappedSource)):
+            self.resident += blob.size
+        return blob
+
+    def share(self, blob):
+        blob.refs += 1
+        return blob
+
+    def adopt(self, blob):
+        # Blob из хранилища другой VFS (нижнего слоя): содержимое общее, счетчик ссылок свой
+        own = self.blobs.get(blob.key)
+        if own is None:
+            own = self._add(Blob(blob.key, blob.content, blob.size))
+        own.refs += 1
+        return own
+
+    def release(self, blob):
+        blob.refs -= 1
+        if blob.refs <= 0:
+            del self.blobs[blob.key]
+            self.size -= blob.size
+            if not isinstance(blob.content, (ZipMemberSource, MappedSource)):
+                self.resident -= blob.size
+
+    def total_size(self):
+        return self.size
+
+
+class ContentCache:
+    # LRU-кэш распакованного содержимого с ограничением по объему в байтах.
+    # Распаковка идет без блокировки, под ней только обновление LRU
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def get(self, source):
+        with self.lock:
+            entry = self.entries.get(source)
+            if entry is not None:
+                self.entries.move_to_end(source)
+                return entry[0]
+
+        content = decode_content(source.read())
+        size = source.size
+        if size <= self.max_bytes:
+            with self.lock:
+                if source not in self.entries:
+                    self.entries[source] = (content, size)
+                    self.used += size
+                while self.used > self.max_bytes:
+                    _, (_, evicted_size) = self.entries.popitem(last=False)
+                    self.used -= evicted_size
+        return content
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+
+
+class RWLock:
+    # Много читателей или один писатель; ждущий писатель не пропускает новых читателей.
+    # Поток может повторно захватывать блокировку (операции VFS вызывают друг друга)
+    # и читать под своей блокировкой записи, но не может повысить чтение до записи
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._cond = threading.Condition(self._mutex)
+        self._readers = 0
+        self._writer = None
+        self._write_depth = 0
+        self._writers_waiting = 0
+        self._local = threading.local()
+
+    def acquire_read(self):
+        local = self._local
+        depth = getattr(local, "depth", 0)
+        if depth:
+            local.depth = depth + 1
+            return
+        if self._writer == threading.get_ident():
+            local.counted = False
+        else:
+            with self._mutex:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+                self._readers += 1
+            local.counted = True
+        local.depth = 1
+
+    def release_read(self):
+        local = self._local
+        local.depth -= 1
+        if local.depth or not local.counted:
+            return
+        with self._mutex:
+            self._readers -= 1
+            if not self._readers and self._writers_waiting:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            self._write_depth += 1
+            return
+        if getattr(self._local, "depth", 0):
+            raise RuntimeError("Нельзя изменять VFS, удерживая блокировку чтения")
+        with self._mutex:
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._write_depth = 1
+
+    def release_write(self):
+        self._write_depth -= 1
+        if not self._write_depth:
+            with self._mutex:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class Stats:
+    # Счетчики вызовов и гистограммы времени выполнения команд и операций VFS
+    BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+    BUCKET_LABELS = ("<10мкс", "<100мкс", "<1мс", "<10мс", "<100мс", "<1с", ">=1с")
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, elapsed):
+        bucket = 0
+        while bucket < len(self.BUCKETS) and elapsed >= self.BUCKETS[bucket]:
+            bucket += 1
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                entry = self.entries[name] = [0, 0.0, elapsed, elapsed, [0] * len(self.BUCKET_LABELS)]
+            entry[0] += 1
+            entry[1] += elapsed
+            if elapsed < entry[2]:
+                entry[2] = elapsed
+            if elapsed > entry[3]:
+                entry[3] = elapsed
+            entry[4][bucket] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {name: (entry[0], entry[1]) for name, entry in self.entries.items()}
+
+    def diff(self, before):
+        result = []
+        for name, entry in self._items():
+            count, total = before.get(name, (0, 0.0))
+            if entry[0] > count:
+                result.append((name, entry[0] - count, entry[1] - total))
+        return sorted(result, key=lambda item: -item[2])
+
+    def _items(self):
+        with self.lock:
+            return [(name, list(entry)) for name, entry in self.entries.items()]
+
+    def reset(self):
+        with self.lock:
+            self.entries.clear()
+
+    def report(self):
+        lines = [f"{'имя':28} {'вызовов':>8} {'всего, мс':>11} {'сред, мкс':>10} {'макс, мкс':>10}  гистограмма"]
+        for name, (count, total, _, longest, buckets) in sorted(self._items(), key=lambda item: -item[1][1]):
+            histogram = " ".join(f"{label}:{n}" for label, n in zip(self.BUCKET_LABELS, buckets) if n)
+            lines.append(f"{name:28} {count:8} {total * 1e3:11.3f} {total / count * 1e6:10.1f} "
+                         f"{longest * 1e6:10.1f}  {histogram}")
+        return lines
+
+
+def node_path(node):
+    parts = []
+    while node.parent is not None:
+        parts.append(node.name)
+        node = node.parent
+    return "/" + "/".join(reversed(parts))
+
+
+def node_depth(node, ancestor):
+    # Глубина node относительно ancestor или -1, если node лежит вне ancestor
+    depth = 0
+    while node is not ancestor:
+        node = node.parent
+        if node is None:
+            return -1
+        depth += 1
+    return depth
+
+
+REGEX_SPECIAL = frozenset(".^$*+?{}[]()|\\")
+
+
+def regex_literals(pattern):
+    # Строки, которые обязательно входят в любое совпадение: последовательности обычных
+    # символов вне групп и классов. При альтернативе '|' ничего гарантировать нельзя
+    literals = []
+    run = []
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum() and not depth:
+                run.append(pattern[i + 1])
+            else:
+                literals.append("".join(run))
+                run = []
+            i += 2
+            continue
+        if char == "|":
+            return []
+        if char == "[":
+            literals.append("".join(run))
+            run = []
+            close = pattern.find("]", i + 2)
+            i = len(pattern) if close < 0 else close + 1
+            continue
+        if char in "*?{" and run:
+            # Предыдущий символ необязателен
+            run.pop()
+        if char == "{":
+            # Цифры квантификатора {m,n} не входят в совпадение
+            literals.append("".join(run))
+            run = []
+            close = pattern.find("}", i + 1)
+            i = len(pattern) if close < 0 else close + 1
+            continue
+        if char in REGEX_SPECIAL or depth:
+            if char == "(":
+                depth += 1
+            elif char == ")" and depth:
+                depth -= 1
+            literals.append("".join(run))
+            run = []
+        else:
+            run.append(char)
+        i += 1
+    literals.append("".join(run))
+    return [literal for literal in literals if len(literal) >= 3]
+
+
+def prefix_range(names, prefix):
+    # Границы имен с префиксом в отсортированном списке
+    start = bisect.bisect_left(names, prefix)
+    end = bisect.bisect_right(names, prefix, lo=start, key=lambda name: name[:len(prefix)])
+    return start, end
+
+
+def trigrams(text):
+    text = text.lower()
+    return set(zip(text, text[1:], text[2:]))
+
+
+class SearchIndex:
+    # Индекс для find и grep: имя -> узлы с этим именем и, если включен, триграммы
+    # текстового содержимого -> blob'ы. Blob неизменяем, поэтому триграммы считаются
+    # один раз на содержимое, а копии файлов только добавляют узел в blob_nodes
+    TRIGRAM_MAX_CHARS = 1024 * 1024
+
+    def __init__(self):
+        self.names = {}
+        self.trigrams = None
+        self.blob_trigrams = {}
+        self.blob_nodes = {}
+        self.unindexed = set()
+
+    def add(self, node):
+        nodes = self.names.get(node.name)
+        if nodes is None:
+            nodes = self.names[node.name] = set()
+        nodes.add(node)
+
+    def discard(self, node):
+        nodes = self.names.get(node.name)
+        if nodes is not None:
+            nodes.discard(node)
+            if not nodes:
+                del self.names[node.name]
+
+    def match_names(self, pattern):
+        if not any(char in pattern for char in "*?["):
+            return self.names.get(pattern, ())
+        regex = re.compile(fnmatch.translate(pattern))
+        return [node for name, nodes in self.names.items() if regex.match(name) for node in nodes]
+
+    def add_file(self, node, text):
+        # text - содержимое файла как str или None для двоичных файлов
+        blob = node.blob
+        nodes = self.blob_nodes.get(blob)
+        if nodes is None:
+            nodes = self.blob_nodes[blob] = set()
+            if text is None or len(text) > self.TRIGRAM_MAX_CHARS:
+                self.unindexed.add(blob)
+            else:
+                grams = self.blob_trigrams[blob] = trigrams(text)
+                for gram in grams:
+                    blobs = self.trigrams.get(gram)
+                    if blobs is None:
+                        blobs = self.trigrams[gram] = set()
+                    blobs.add(blob)
+        nodes.add(node)
+
+    def discard_file(self, node):
+        blob = node.blob
+        nodes = self.blob_nodes.get(blob)
+        if nodes is None:
+            return
+        nodes.discard(node)
+        if nodes:
+            return
+        del self.blob_nodes[blob]
+        self.unindexed.discard(blob)
+        for gram in self.blob_trigrams.pop(blob, ()):
+            blobs = self.trigrams[gram]
+            blobs.discard(blob)
+            if not blobs:
+                del self.trigrams[gram]
+
+    def candidates(self, literals):
+        # Blob'ы, которые могут содержать все literals, или None, если индекс не поможет
+        grams = set()
+        for literal in literals:
+            grams |= trigrams(literal)
+        if self.trigrams is None or not grams:
+            return None
+        result = None
+        for gram in sorted(grams, key=lambda gram: len(self.trigrams.get(gram, ()))):
+            blobs = self.trigrams.get(gram)
+            if not blobs:
+                result = set()
+                break
+            result = set(blobs) if result is None else result & blobs
+            if not result:
+                break
+        return result | self.unindexed
+
+
+# Поиск по всему тексту дает надмножество построчных совпадений, только если шаблон
+# не смотрит за границы строки: с такими конструкциями строки проверяются все
+PREFILTER_UNSAFE = ("\\A", "\\Z", "(?=", "(?!", "(?<=", "(?<!")
+
+
+def grep_text(text, regex, prefilter):
+    # Сначала одно сканирование всего текста, по строкам - только если есть совпадение
+    if prefilter is not None and prefilter.search(text) is None:
+        return []
+    return [(line_num, line) for line_num, line in enumerate(text.split("\n"), 1) if regex.search(line)]
+
+
+def content_text(content):
+    if isinstance(content, str):
+        return content
+    return decode_line(content)
+
+
+_grep_job = None
+_worker_zips = {}
+
+
+def _init_grep_worker(job):
+    # Задание приходит в аргументах initializer: при fork они наследуются без pickle,
+    # и у каждого пула свое задание даже при одновременных grep
+    global _grep_job
+    _grep_job = job
+
+
+def _worker_read(source):
+    # После fork нельзя читать через общий с родителем дескриптор архива: позиция в файле
+    # общая. Воркер открывает архив заново
+    if isinstance(source, MappedSource):
+        return source.read()
+    if isinstance(source, ZipMemberSource):
+        path = source.zip_ref.filename
+        zip_ref = _worker_zips.get(path)
+        if zip_ref is None:
+            zip_ref = _worker_zips[path] = zipfile.ZipFile(path)
+        return zip_ref.read(source.info)
+    return source
+
+
+def _grep_range(start, count):
+    files, regex, prefilter = _grep_job
+    matches = []
+    for path, node in files[start:start + count]:
+        for line_num, line in grep_text(content_text(_worker_read(node.blob.content)), regex, prefilter):
+            matches.append((path, line_num, line))
+    return matches
+
+
+JOURNAL_MAGIC = b"VFSJRNL1"
+JOURNAL_RECORD = struct.Struct("<BII")
+JOURNAL_FIELD = struct.Struct("<I")
+JOURNAL_CREATE = 1
+JOURNAL_COPY = 2
+JOURNAL_COPY_TREE = 3
+JOURNAL_WRITE = 4
+JOURNAL_APPEND = 5
+JOURNAL_LOAD = 6
+JOURNAL_MOUNT = 7
+JOURNAL_OP_NAMES = {JOURNAL_CREATE: "create", JOURNAL_COPY: "copy", JOURNAL_COPY_TREE: "copy -r",
+                    JOURNAL_WRITE: "write", JOURNAL_APPEND: "append", JOURNAL_LOAD: "vfs",
+                    JOURNAL_MOUNT: "mount"}
+
+
+class Journal:
+    # Журнал изменений VFS: записи дописываются в конец файла (операция, длина, crc32, поля),
+    # fsync выполняется пачками - раз в sync_every записей или sync_interval секунд
+    def __init__(self, path, sync_every=64, sync_interval=1.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.pending = 0
+        self.records = 0
+        self.last_sync = time.monotonic()
+        self.lock = threading.Lock()
+        self.file = open(path, 'a+b')
+        if self.file.seek(0, os.SEEK_END) == 0:
+            self.file.write(JOURNAL_MAGIC)
+            self._sync()
+
+    def read(self):
+        # Записи до первой оборванной или поврежденной; хвост после нее (след сбоя) отрезается
+        with self.lock:
+            self.file.flush()
+            self.file.seek(0)
+            data = self.file.read()
+            if not data.startswith(JOURNAL_MAGIC):
+                raise ValueError(f"Неверный формат журнала: {self.path}")
+            records = []
+            pos = len(JOURNAL_MAGIC)
+            while pos + JOURNAL_RECORD.size <= len(data):
+                op, length, crc = JOURNAL_RECORD.unpack_from(data, pos)
+                start = pos + JOURNAL_RECORD.size
+                payload = data[start:start + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                fields = []
+                offset = 0
+                while offset < length:
+                    (size,) = JOURNAL_FIELD.unpack_from(payload, offset)
+                    offset += JOURNAL_FIELD.size
+                    fields.append(payload[offset:offset + size])
+                    offset += size
+                records.append((op, fields))
+                pos = start + length
+            if pos < len(data):
+                self.file.truncate(pos)
+                self._sync()
+            self.records = len(records)
+            return records
+
+    def append(self, op, *fields):
+        payload = b"".join(JOURNAL_FIELD.pack(len(field)) + field for field in fields)
+        with self.lock:
+            self.file.write(JOURNAL_RECORD.pack(op, len(payload), zlib.crc32(payload)) + payload)
+            self.records += 1
+            self.pending += 1
+            if (self.pending >= self.sync_every
+                    or time.monotonic() - self.last_sync >= self.sync_interval):
+                self._sync()
+
+    def sync(self):
+        with self.lock:
+            if self.pending:
+                self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def reset(self):
+        with self.lock:
+            self.file.truncate(len(JOURNAL_MAGIC))
+            self.records = 0
+            self._sync()
+
+    def size(self):
+        with self.lock:
+            self.file.flush()
+            return os.fstat(self.file.fileno()).st_size
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def timed(func):
+    # Замер операции VFS, если к ней подключен объект Stats
+    name = "vfs." + func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        stats = self.stats
+        if stats is None:
+            return func(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            stats.record(name, time.perf_counter() - start)
+    return wrapper
+
+
+def timed_iter(func):
+    # Замер операции VFS, которая отдает итератор: к вызову добавляется время каждого шага
+    # обхода, но не обработка элементов вызывающим кодом. Записывается, когда обход
+    # закончен или итератор закрыт
+    name = "vfs." + func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        stats = self.stats
+        if stats is None:
+            return func(self, *args, **kwargs)
+        start = time.perf_counter()
+        items = func(self, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if items is None:
+            stats.record(name, elapsed)
+            return None
+        return _timed_steps(stats, name, iter(items), elapsed)
+    return wrapper
+
+
+def _timed_steps(stats, name, items, elapsed):
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                elapsed += time.perf_counter() - start
+                return
+            elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        # Закрытие передается дальше: обход может держать блокировку чтения
+        close = getattr(items, "close", None)
+        if close is not None:
+            close()
+        stats.record(name, elapsed)
+
+
+def reading(func):
+    # Операция VFS под блокировкой чтения
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        lock = self.lock
+        lock.acquire_read()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            lock.release_read()
+    return wrapper
+
+
+def writing(func):
+    # Операция VFS под блокировкой записи
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        lock = self.lock
+        lock.acquire_write()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            lock.release_write()
+    return wrapper
+
+
+class FilesystemView(MutableMapping):
+    # Плоское представление дерева VFS в старом формате:
+    # "/" и "dir/" - директории (значение None), "dir/file" - файлы.
+    def __init__(self, vfs):
+        self.vfs = vfs
+
+    def __getitem__(self, key):
+        node = self.vfs._lookup(key)
+        if node is None or node.is_dir() != (key.endswith("/") or key == ""):
+            raise KeyError(key)
+        return None if node.is_dir() else self.vfs._content(node)
+
+    def __setitem__(self, key, value):
+        if key.endswith("/"):
+            if self.vfs._ensure_dir(split_path(key)) is None:
+                raise KeyError(key)
+            return
+        parts = split_path(key)
+        parent = self.vfs._ensure_dir(parts[:-1])
+        if not parts or parent is None or isinstance(parent.children.get(parts[-1]), DirNode):
+            raise KeyError(key)
+        self.vfs._put_file(parent, parts[-1], value)
+
+    def __iter__(self):
+        for path, node in self.vfs._walk():
+            yield path
+
+    def __delitem__(self, key):
+        node = self.vfs._lookup(key)
+        if node is None or node.parent is None or node.is_dir() != key.endswith("/"):
+            raise KeyError(key)
+        self.vfs._remove(node)
+
+    def __len__(self):
+        count = 1
+        stack = [self.vfs.root]
+        while stack:
+            node = stack.pop()
+            count += len(node.children)
+            stack.extend(child for child in node.children.values() if child.is_dir())
+        return count
+
 
 class VFS:
-    def __init__(self, zip_path=None):
-        self.filesystem = {}
+    DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+    PATH_CACHE_SIZE = 8192
+    CHUNK_SIZE = 64 * 1024
+    SPOOL_THRESHOLD = 1024 * 1024
+    DEFAULT_COMPRESSLEVEL = 6
+
+    def __init__(self, zip_path=None, lazy=False, cache_bytes=DEFAULT_CACHE_BYTES, stats=None,
+                 use_mmap=True, journal_path=None, trigrams=False, layers=None):
+        self.root = DirNode()
         self.curr_dir = "/"
-        if zip_path:
-            self.load_from_zip(zip_path)
+        self.lazy = lazy
+        self.use_mmap = use_mmap
+        self.blobs = BlobStore()
+        self.cache = ContentCache(cache_bytes)
+        self.stats = stats
+        self.lock = RWLock()
+        self.index = SearchIndex()
+        self._abs_paths = {}
+        self._rel_paths = {}
+        self._rel_paths_dir = self.curr_dir
+        self.base_path = zip_path
+        self.journal = None
+        self.lowers = []
+        # Открытые архивы этой VFS (ZipFile, mmap или None), из которых читаются ленивые файлы
+        self._archives = []
+        self._mount_lock = threading.Lock()
+        self._expanded = True
+        if layers:
+            # Архив zip_path поверх слоев загружается в верхний слой
+            self.mount(layers)
+            if zip_path:
+                self.load(zip_path)
+        elif zip_path:
+            self.load(zip_path)
         else:
             self.create_default_vfs()
-    
-    def load_from_zip(self, zip_path):
+        if trigrams:
+            self.build_trigram_index()
+        if journal_path:
+            self.open_journal(journal_path)
+
+    @property
+    def filesystem(self):
+        return FilesystemView(self)
+
+    @filesystem.setter
+    @writing
+    def filesystem(self, entries):
+        self.root = DirNode()
+        self.blobs = BlobStore()
+        trigrams = self.index.trigrams is not None
+        self.index = SearchIndex()
+        if trigrams:
+            self.index.trigrams = {}
+        view = FilesystemView(self)
+        for path, content in entries.items():
+            view[path] = content
+
+    def _lookup(self, path):
+        node = self.root
+        for part in split_path(path):
+            if not node.is_dir():
+                return None
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def _ensure_dir(self, parts):
+        node = self.root
+        for part in parts:
+            child = node.children.get(part)
+            if child is None:
+                child = DirNode(part, node)
+                node.add(part, child)
+                self.index.add(child)
+            elif not child.is_dir():
+                return None
+            node = child
+        return node
+
+    def _account(self, node, size, files):
+        # Изменение объема поддерева поднимается до корня: O(глубины)
+        while node is not None:
+            node.size += size
+            node.files += files
+            node = node.parent
+
+    def _put_file(self, parent, name, content, origin=None):
+        old = parent.children.get(name)
+        node = parent.add(name, FileNode(name, parent, self.blobs.put(content), origin))
+        self._account(parent, node.blob.size, 1)
+        if old is not None:
+            self._release(old)
+        self._index_file(node)
+        return node
+
+    def _link_file(self, parent, name, src_node):
+        # Копия файла - новая ссылка на тот же blob, данные не дублируются
+        old = parent.children.get(name)
+        node = parent.add(name, FileNode(name, parent, self.blobs.share(src_node.blob), src_node.origin))
+        self._account(parent, node.blob.size, 1)
+        if old is not None:
+            self._release(old)
+        self._index_file(node)
+        return node
+
+    def _index_file(self, node):
+        index = self.index
+        index.add(node)
+        if index.trigrams is not None:
+            index.add_file(node, None if node.blob in index.blob_nodes else self._index_text(node))
+
+    def _index_text(self, node):
+        if node.blob.size > SearchIndex.TRIGRAM_MAX_CHARS * 4:
+            return None
+        content = self._content(node, cached=False)
+        if not isinstance(content, str):
+            content = decode_content(bytes(content))
+        return content if isinstance(content, str) else None
+
+    def _release(self, node):
+        if node.is_dir():
+            self._account(node.parent, -node.size, -node.files)
+        else:
+            self._account(node.parent, -node.blob.size, -1)
+        index = self.index
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            index.discard(node)
+            if isinstance(node, OverlayDirNode) and node.owner is not None:
+                # Неоткрытая директория слоев ничего не занимает в этой VFS
+                continue
+            if node.is_dir():
+                stack.extend(node.children.values())
+            else:
+                self.blobs.release(node.blob)
+                index.discard_file(node)
+
+    def _remove(self, node):
+        node.parent.remove(node.name)
+        self._release(node)
+
+    def _walk(self):
+        yield "/", self.root
+        stack = [(self.root, "")]
+        while stack:
+            node, prefix = stack.pop()
+            subdirs = []
+            for name, child in node.children.items():
+                if child.is_dir():
+                    yield prefix + name + "/", child
+                    subdirs.append((child, prefix + name + "/"))
+                else:
+                    yield prefix + name, child
+            stack.extend(reversed(subdirs))
+
+    @writing
+    def mount(self, layers):
+        # Дерево заменяется объединением слоев (нижний первым) с пустым верхним слоем в памяти.
+        # Слои - пути к архивам (загружаются один раз на процесс) или готовые VFS
+        lowers = [layer if isinstance(layer, VFS) else load_layer(layer) for layer in layers]
+        if not any(isinstance(layer, VFS) for layer in layers):
+            self._log(JOURNAL_MOUNT, *(os.path.abspath(layer) for layer in layers))
+        trigrams = self.index.trigrams is not None
+        self.blobs = BlobStore()
+        self.index = SearchIndex()
+        if trigrams:
+            self.index.trigrams = {}
+        self.cache = lowers[0].cache
+        self.lowers = lowers
+        self.root = OverlayDirNode("", None, self, [lower.root for lower in reversed(lowers)])
+        self._open_layers(self.root)
+        self._expanded = False
+        self.curr_dir = "/"
+        self.base_path = None
+        if trigrams:
+            self._expand()
+
+    def overlay(self):
+        # Новая VFS со своим верхним слоем поверх этой, которая дальше не должна изменяться:
+        # так сессии делят одну загруженную базу
+        return VFS(stats=self.stats, layers=[self])
+
+    def _materialize(self, node):
+        # Содержимое директории переносится из слоев при первом обращении: файлы ссылаются
+        # на данные слоев, поддиректории остаются неоткрытыми
+        with self._mount_lock:
+            if node.owner is not None:
+                size, files = node.size, node.files
+                self._merge_children(node)
+                if node.size != size or node.files != files:
+                    self._account(node.parent, node.size - size, node.files - files)
+
+    def _open_layers(self, node):
+        # Объем директории из одного слоя известен слою; директорию из нескольких слоев
+        # (имена могут перекрываться и скрываться) приходится собрать сразу
+        if len(node.lowers) == 1:
+            node.size = node.lowers[0].size
+            node.files = node.lowers[0].files
+        else:
+            self._merge_children(node)
+
+    def _merge_children(self, node):
+        children = node._children
+        size = files = 0
+        for name, entry in merge_layers(node.lowers).items():
+            if isinstance(entry, list):
+                child = children[name] = OverlayDirNode(name, node, self, entry)
+                self.index.add(child)
+                self._open_layers(child)
+                size += child.size
+                files += child.files
+            else:
+                child = children[name] = FileNode(name, node, self.blobs.adopt(entry.blob), entry.origin)
+                self._index_file(child)
+                size += child.blob.size
+                files += 1
+        node.size = size
+        node.files = files
+        node.owner = None
+
+    def _expand(self):
+        # Индексам нужны все узлы: перед поиском по индексу открываются все директории
+        if not self._expanded:
+            for path, node in self._walk():
+                pass
+            self._expanded = True
+
+    def _content(self, node, cached=True):
+        content = node.blob.content
+        if isinstance(content, MappedSource):
+            return content.read()
+        if isinstance(content, ZipMemberSource):
+            if cached:
+                return self.cache.get(content)
+            return decode_content(content.read())
+        return content
+
+    @writing
+    def open_journal(self, journal_path):
+        # Изменения из журнала применяются поверх загруженного образа
+        journal = Journal(journal_path)
+        applied, failed = self.replay_journal(journal.read())
+        self.journal = journal
+        if applied:
+            print(f"Из журнала {journal_path} применено изменений: {applied}")
+        for number, op_name, path, message in failed:
+            print(f"Журнал {journal_path}: запись {number} ({op_name} {path}) не применена: {message}")
+
+    @writing
+    def replay_journal(self, records):
+        # Число примененных записей и список непримененных: (номер, операция, путь, причина)
+        applied = 0
+        failed = []
+        for number, (op, fields) in enumerate(records, 1):
+            paths = ["/" + str(field, 'utf-8').lstrip("/") for field in fields[:2]]
+            try:
+                if op == JOURNAL_CREATE:
+                    content = str(fields[2], 'utf-8') if fields[1] == b"t" else fields[2]
+                    success, message = self.create_file(paths[0], content)
+                elif op == JOURNAL_COPY:
+                    success, message = self.copy_file(*paths)
+                elif op == JOURNAL_COPY_TREE:
+                    success, message = self.copy_tree(*paths)
+                elif op in (JOURNAL_WRITE, JOURNAL_APPEND):
+                    content = str(fields[2], 'utf-8') if fields[1] == b"t" else fields[2]
+                    success, message = self.write_file(paths[0], content, append=op == JOURNAL_APPEND)
+                elif op == JOURNAL_LOAD:
+                    self.load(str(fields[0], 'utf-8'), lazy=fields[1] == b"l")
+                    success, message = True, ""
+                elif op == JOURNAL_MOUNT:
+                    self.mount([str(field, 'utf-8') for field in fields])
+                    success, message = True, ""
+                else:
+                    success, message = False, "неизвестная операция"
+            except Exception as e:
+                success, message = False, str(e)
+            if success:
+                applied += 1
+            else:
+                failed.append((number, JOURNAL_OP_NAMES.get(op, str(op)),
+                               paths[0] if paths else "", message))
+        return applied, failed
+
+    def _log(self, op, *fields):
+        if self.journal is not None:
+            self.journal.append(op, *(field.encode('utf-8') if isinstance(field, str) else bytes(field)
+                                      for field in fields))
+
+    @timed
+    @writing
+    def compact_journal(self):
+        # Журнал сворачивается в новый образ на месте базового, после чего очищается
+        if self.journal is None:
+            return False, "Журнал не подключен"
+        if not self.base_path:
+            return False, "Нет базового образа для сворачивания журнала"
+        records = self.journal.records
+        if self.base_path.endswith(SNAPSHOT_EXT) or is_snapshot(self.base_path):
+            success, message = self.save_snapshot(self.base_path)
+        else:
+            success, message = self.save_to_zip(self.base_path)
+        if not success:
+            return False, message
+        return True, f"{message}; свернуто записей журнала: {records}"
+
+    def _saved_base(self, path):
+        # Сохраненный образ - контрольная точка: он содержит все изменения из журнала,
+        # и журнал начинается заново. Образ не на месте базового журнал загружает первой записью,
+        # иначе записи о загрузках по ссылке на перезаписанный архив применились бы повторно
+        if self.journal is not None:
+            self.journal.reset()
+            if not (self.base_path and os.path.abspath(path) == os.path.abspath(self.base_path)):
+                self._log(JOURNAL_LOAD, os.path.abspath(path), b"l" if self.lazy else b"")
+
+    def sync_journal(self):
+        if self.journal is not None:
+            self.journal.sync()
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def load(self, path, lazy=None):
+        # Загрузка поверх текущего дерева попадает в журнал: от нее зависят следующие записи
+        lazy = self.lazy if lazy is None else lazy
+        if os.path.exists(path) and is_snapshot(path):
+            self.load_snapshot(path)
+        else:
+            self.load_from_zip(path, lazy)
+        self._log(JOURNAL_LOAD, os.path.abspath(path), b"l" if lazy else b"")
+
+    @timed
+    @writing
+    def load_snapshot(self, snapshot_path):
+        # Снимок открывается через mmap: разбираются только таблицы, данные не читаются
+        try:
+            with open(snapshot_path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, entry_count, blob_count, names_size, blobs_offset = SNAPSHOT_HEADER.unpack_from(mapped, 0)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError(f"Неверный формат снимка: {snapshot_path}")
+            
+            entries_offset = SNAPSHOT_HEADER.size
+            blob_table_offset = entries_offset + entry_count * SNAPSHOT_ENTRY.size
+            names_offset = blob_table_offset + blob_count * SNAPSHOT_BLOB.size
+            names = str(mapped[names_offset:names_offset + names_size], 'utf-8').split("\0")
+            blob_table = list(SNAPSHOT_BLOB.iter_unpack(
+                memoryview(mapped)[blob_table_offset:names_offset]))
+            blobs = [None] * blob_count
+            
+            nodes = [self.root]
+            entries = SNAPSHOT_ENTRY.iter_unpack(memoryview(mapped)[entries_offset:blob_table_offset])
+            next(entries)
+            for index, (parent_index, blob_index) in enumerate(entries, 1):
+                parent = nodes[parent_index]
+                name = names[index]
+                existing = parent.children.get(name)
+                if blob_index == SNAPSHOT_NO_INDEX:
+                    if existing is None:
+                        existing = parent.add(name, DirNode(name, parent))
+                        self.index.add(existing)
+                    elif not existing.is_dir():
+                        raise ValueError(f"Конфликт пути в снимке: {name}")
+                    nodes.append(existing)
+                    continue
+                
+                if existing is not None and existing.is_dir():
+                    raise ValueError(f"Конфликт пути в снимке: {name}")
+                blob = blobs[blob_index]
+                if blob is None:
+                    offset, size = blob_table[blob_index]
+                    blob = blobs[blob_index] = self.blobs.put(MappedSource(mapped, blobs_offset + offset, size))
+                else:
+                    self.blobs.share(blob)
+                node = parent.add(name, FileNode(name, parent, blob))
+                self._account(parent, blob.size, 1)
+                if existing is not None:
+                    self._release(existing)
+                self._index_file(node)
+                nodes.append(None)
+            
+            print(f"VFS загружена из снимка {snapshot_path}")
+        except Exception as e:
+            raise Exception(f"Ошибка загрузки снимка VFS: {str(e)}")
+
+    @timed
+    @reading
+    def save_snapshot(self, snapshot_path):
+        tmp_path = snapshot_path + ".tmp"
+        try:
+            entries = []
+            names = []
+            blob_index = {}
+            blob_order = []
+            node_index = {}
+            for path, node in self._walk():
+                node_index[id(node)] = len(entries)
+                parent = SNAPSHOT_NO_INDEX if node.parent is None else node_index[id(node.parent)]
+                names.append(node.name)
+                if node.is_dir():
+                    entries.append(SNAPSHOT_ENTRY.pack(parent, SNAPSHOT_NO_INDEX))
+                    continue
+                # Одинаковое содержимое (общий blob) записывается один раз
+                index = blob_index.get(id(node.blob))
+                if index is None:
+                    index = blob_index[id(node.blob)] = len(blob_order)
+                    blob_order.append(node)
+                entries.append(SNAPSHOT_ENTRY.pack(parent, index))
+            
+            names_data = "\0".join(names).encode('utf-8')
+            tables_size = (SNAPSHOT_HEADER.size + len(entries) * SNAPSHOT_ENTRY.size
+                           + len(blob_order) * SNAPSHOT_BLOB.size + len(names_data))
+            blobs_offset = (tables_size + 7) // 8 * 8
+            
+            with open(tmp_path, 'wb') as f:
+                f.seek(blobs_offset)
+                blob_table = []
+                for node in blob_order:
+                    offset = f.tell() - blobs_offset
+                    for chunk in self._chunks(node, self.CHUNK_SIZE):
+                        f.write(chunk)
+                    blob_table.append(SNAPSHOT_BLOB.pack(offset, f.tell() - blobs_offset - offset))
+                
+                f.seek(0)
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(entries), len(blob_order),
+                                             len(names_data), blobs_offset))
+                f.write(b"".join(entries))
+                f.write(b"".join(blob_table))
+                f.write(names_data)
+            os.replace(tmp_path, snapshot_path)
+            self._saved_base(snapshot_path)
+            return True, f"Снимок VFS сохранен в {snapshot_path} (записей: {len(entries)}, blob: {len(blob_order)})"
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False, f"Ошибка сохранения снимка VFS: {str(e)}"
+
+    @timed
+    @writing
+    def load_from_zip(self, zip_path, lazy=None):
+        lazy = self.lazy if lazy is None else lazy
         try:
             if not os.path.exists(zip_path):
                 raise FileNotFoundError(f"ZIP-файл не найден: {zip_path}")
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                for file_info in zip_ref.infolist():
-                    if file_info.is_dir():
-                        dir_path = file_info.filename
-                        if not dir_path.endswith('/'):
-                            dir_path += '/'
-                        self.filesystem[dir_path] = None
+            # Архив остается открытым: из него читаются ленивые файлы
+            # и копируются без пересжатия неизмененные члены при savevfs.
+            # Несжатые члены и без --lazy читаются прямо из отображенного в память архива
+            # вместо копии в памяти, сессии на одном образе делят страничный кэш ОС
+            zip_ref, mapped = self._open_archive(zip_path, self.use_mmap)
+            for file_info in zip_ref.infolist():
+                parts = split_path(file_info.filename)
+                if file_info.is_dir():
+                    if self._ensure_dir(parts) is None:
+                        raise ValueError(f"Конфликт пути в архиве: {file_info.filename}")
+                else:
+                    source = ZipMemberSource(zip_ref, file_info)
+                    if mapped is not None and file_info.compress_type == zipfile.ZIP_STORED \
+                            and not file_info.flag_bits & 0x1:
+                        content = MappedMemberSource(mapped, file_info)
+                    elif lazy:
+                        content = source
                     else:
-                        content = zip_ref.read(file_info.filename)
-                        try:
-                            content = content.decode('utf-8')
-                        except UnicodeDecodeError:
-                            content = "base64:" + base64.b64encode(content).decode('utf-8')
-                        self.filesystem[file_info.filename] = content
+                        content = decode_content(zip_ref.read(file_info))
+                    parent = self._ensure_dir(parts[:-1])
+                    if parent is None or isinstance(parent.children.get(parts[-1]), DirNode):
+                        raise ValueError(f"Конфликт пути в архиве: {file_info.filename}")
+                    self._put_file(parent, parts[-1], content, source)
             
             print(f"VFS загружена из {zip_path}")
             
@@ -48,7 +1459,7 @@ class VFS:
         self.filesystem = {
             "/": None,
             "bin/": None,
-            "bin/app.exe": "base64:ZXhlY3V0YWJsZSBiaW5hcnkgZGF0YQ==",
+            "bin/app.exe": b"executable binary data",
             "documents/": None,
             "documents/report.txt": "Отчет за 2025 год \nВсе работает отлично!",
             "documents/projects/": None,
@@ -60,8 +1471,26 @@ class VFS:
         }
      
     def normalize_path(self, path):
+        # Без @timed: вызывается в каждой операции, и замер стоил бы дороже попадания в кэш
         if path == ".":
             return self.curr_dir
+        if path.startswith("/"):
+            cache = self._abs_paths
+        else:
+            # Относительные пути зависят от текущей директории: при cd кэш сбрасывается
+            if self._rel_paths_dir != self.curr_dir:
+                self._rel_paths.clear()
+                self._rel_paths_dir = self.curr_dir
+            cache = self._rel_paths
+
+        result = cache.get(path)
+        if result is None:
+            if len(cache) >= self.PATH_CACHE_SIZE:
+                cache.clear()
+            result = cache[path] = sys.intern(self._resolve_path(path))
+        return result
+
+    def _resolve_path(self, path):
         if not path.startswith("/"):
             path = os.path.join(self.curr_dir, path).replace("\\", "/")
 
@@ -80,297 +1509,1062 @@ class VFS:
         
         return result_path or "/"
     
+    @timed
     def list_dir(self, path="."):
+        return list(self.iter_dir(path))
+
+    @timed_iter
+    @reading
+    def iter_dir(self, path="."):
         normalized_path = self.normalize_path(path)
+        node = self._lookup(normalized_path)
         
-        if normalized_path in self.filesystem and not normalized_path.endswith("/"):
-            return [os.path.basename(normalized_path)]
-        
-        if not normalized_path.endswith("/") and normalized_path != "/":
-            normalized_path += "/"
+        if node is None:
+            return iter(())
+        if not node.is_dir():
+            if normalized_path.endswith("/"):
+                return iter(())
+            return iter((node.name,))
         
-        items = set()
-        
-        for file_path in self.filesystem.keys():
-            if normalized_path == "/":
-                if file_path == "/":
-                    continue
-                if "/" in file_path:
-                    first_item = file_path.split("/")[0]
-                    if "/" in file_path[len(first_item):]:
-                        items.add(first_item + "/")
-                    else:
-                        items.add(first_item)
-                else:
-                    items.add(file_path)
-            else:
-                if file_path.startswith(normalized_path):
-                    rel_path = file_path[len(normalized_path):]
-                    if not rel_path:
-                        continue
-                    
-                    if "/" in rel_path:
-                        first_part = rel_path.split("/")[0]
-                        items.add(first_part + "/")
-                    else:
-                        items.add(rel_path)
+        return iter(node.sorted_labels())
+
+    @timed
+    @reading
+    def complete_path(self, prefix, limit=None):
+        # Дополнение пути: директория находится по компонентам, имена с префиксом -
+        # двоичным поиском в отсортированных labels, без просмотра остальных записей.
+        # Возвращает не больше limit вариантов, общий префикс и число всех совпадений
+        dir_part, _, name_part = prefix.rpartition("/")
+        if prefix.startswith("/") and not dir_part:
+            dir_part = "/"
+        node = self._lookup(self.normalize_path(dir_part or "."))
+        if node is None or not node.is_dir():
+            return []
         
-        return sorted(list(items))
+        labels = node.sorted_labels()
+        head = prefix[:len(prefix) - len(name_part)]
+        start, end = prefix_range(labels, name_part)
+        if start == end:
+            return [], "", 0
+        stop = end if limit is None else min(end, start + limit)
+        return ([head + label for label in labels[start:stop]],
+                head + os.path.commonprefix([labels[start], labels[end - 1]]), end - start)
+
+    @timed
+    @reading
     def read_file(self, file_path):
         normalized_path = self.normalize_path(file_path)
         
         if normalized_path.endswith("/"):
             return None
         
-        if normalized_path in self.filesystem:
-            content = self.filesystem[normalized_path]
-            if content and content.startswith("base64:"):
-                return base64.b64decode(content[7:])
-            return content
+        node = self._lookup(normalized_path)
+        if node is not None and not node.is_dir():
+            return self._content(node)
         return None
     
     
+    @timed
+    @reading
     def change_dir(self, new_dir):
         if new_dir == "/":
             self.curr_dir = "/"
             return True
         
         normalized_path = self.normalize_path(new_dir)
+        node = self._lookup(normalized_path)
         
-        dir_path = normalized_path + "/" if not normalized_path.endswith("/") else normalized_path
-        
-        if dir_path in self.filesystem:
-            self.curr_dir = normalized_path
+        if node is not None and node.is_dir():
+            self.curr_dir = normalized_path.rstrip("/") or "/"
             return True
         
-        for path in self.filesystem.keys():
-            if path.startswith(normalized_path + "/") or path == normalized_path:
-                self.curr_dir = normalized_path
-                return True
-        
         return False
     def get_curr_path(self):
         return self.curr_dir
+
+    def handle(self, curr_dir="/"):
+        return VFSHandle(self, curr_dir)
     
+    @timed
+    @reading
     def get_file_content(self, file_path):
         normalized_path = self.normalize_path(file_path)
+        node = self._lookup(normalized_path)
         
-        if normalized_path in self.filesystem:
-            content = self.filesystem[normalized_path]
-            if content and content.startswith("base64:"):
-                return base64.b64decode(content[7:]).decode('latin-1')
+        if node is not None and not node.is_dir():
+            content = self._content(node)
+            if isinstance(content, memoryview):
+                return decode_line(content)
+            if isinstance(content, bytes):
+                return content.decode('latin-1')
             return content
         return None
+
+    def _file_node(self, file_path):
+        node = self._lookup(self.normalize_path(file_path))
+        if node is None or node.is_dir():
+            return None
+        return node
+
+    def _line_buffer(self, node):
+        # Аргументы для scan_lines над содержимым в памяти или в mmap;
+        # None, если содержимое нужно читать потоком из сжатого архива
+        content = node.blob.content
+        if isinstance(content, MappedSource):
+            start = content.start()
+            return content.mapped, memoryview(content.mapped), b"\n", start, start + content.size, decode_line
+        if isinstance(content, ZipMemberSource):
+            if content not in self.cache.entries and content.size > self.SPOOL_THRESHOLD:
+                return None
+            content = self.cache.get(content)
+        if isinstance(content, str):
+            return content, content, "\n", 0, len(content), str
+        return content, memoryview(content), b"\n", 0, len(content), decode_latin1
+
+    @timed_iter
+    @reading
+    def iter_chunks(self, file_path, chunk_size=None):
+        node = self._file_node(file_path)
+        if node is None:
+            return None
+        return self._chunks(node, chunk_size or self.CHUNK_SIZE)
+
+    def _chunks(self, node, chunk_size):
+        content = node.blob.content
+        if isinstance(content, ZipMemberSource) and content not in self.cache.entries:
+            with content.zip_ref.open(content.info) as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        return
+                    yield chunk
+        content = self._content(node)
+        if isinstance(content, str):
+            for i in range(0, len(content), chunk_size):
+                yield content[i:i + chunk_size].encode('utf-8')
+            return
+        view = memoryview(content)
+        for i in range(0, len(view), chunk_size):
+            yield view[i:i + chunk_size]
+
+    @timed_iter
+    @reading
+    def iter_lines(self, file_path):
+        # Строки файла в том же виде, что и content.split('\n'), но по мере чтения
+        node = self._file_node(file_path)
+        if node is None:
+            return None
+        buffer = self._line_buffer(node)
+        if buffer is not None:
+            return scan_lines(*buffer)
+        return self._stream_lines(node)
+
+    def _stream_lines(self, node):
+        rest = b""
+        for chunk in self._chunks(node, self.CHUNK_SIZE):
+            data = rest + chunk
+            start = 0
+            while True:
+                pos = data.find(b"\n", start)
+                if pos < 0:
+                    break
+                yield decode_line(data[start:pos])
+                start = pos + 1
+            rest = data[start:]
+        yield decode_line(rest)
+
+    @timed_iter
+    @reading
+    def iter_lines_reversed(self, file_path):
+        node = self._file_node(file_path)
+        if node is None:
+            return None
+        buffer = self._line_buffer(node)
+        if buffer is not None:
+            return scan_lines_reversed(*buffer)
+        return self._spooled_lines_reversed(node)
+
+    def _spooled_lines_reversed(self, node):
+        # Сжатый файл нельзя читать с конца: распаковываем его во временный файл
+        # блоками и идем по нему с конца через mmap, не держа содержимое в памяти
+        with tempfile.TemporaryFile() as spool:
+            for chunk in self._chunks(node, self.CHUNK_SIZE):
+                spool.write(chunk)
+            spool.flush()
+            size = spool.tell()
+            if size == 0:
+                yield ""
+                return
+            with mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    yield from scan_lines_reversed(mapped, view, b"\n", 0, size, decode_line)
+                finally:
+                    view.release()
     
+    @timed
+    @reading
     def tree_traverse(self, path, prefix="", depth=-1, current_depth=1):
         if depth >= 0 and current_depth > depth:
             return []
-        normalized_path = self.normalize_path(path)
-        if not normalized_path.endswith("/"):
-            normalized_path += "/"
-        
-        result = []
-        items = self.list_dir(normalized_path)
-        
-        if not items and normalized_path != "/":
+        node = self._lookup(self.normalize_path(path))
+        if node is None or not node.is_dir():
             return []
         
-        for i, item in enumerate(items):
-            is_last = i == len(items) - 1
-            
-            result.append(prefix + ("└── " if is_last else "├── ") + item)
+        return list(self._iter_tree(node, prefix, depth, current_depth))
+
+    @timed_iter
+    @reading
+    def iter_tree(self, path=".", depth=-1):
+        node = self._lookup(self.normalize_path(path))
+        if node is None or not node.is_dir():
+            return iter(())
+        return self._read_locked(self._iter_tree(node, "", depth, 1))
+
+    def _read_locked(self, lines):
+        # Обход держит блокировку чтения от первой строки до конца или закрытия генератора,
+        # поэтому видит дерево целиком на один момент времени
+        with self.lock.read():
+            yield from lines
+
+    def _iter_tree(self, node, prefix, depth, current_depth):
+        # Обход в глубину на явном стеке: строки отдаются по одной по мере обхода
+        stack = [(node, prefix, current_depth, 0)]
+        while stack:
+            node, prefix, level, index = stack.pop()
+            labels = node.sorted_labels()
+            if index >= len(labels):
+                continue
+            label = labels[index]
+            is_last = index == len(labels) - 1
+            stack.append((node, prefix, level, index + 1))
             
-            if item.endswith("/"): 
+            yield prefix + ("└── " if is_last else "├── ") + label
+            if label.endswith("/") and (depth < 0 or level < depth):
                 next_prefix = prefix + ("    " if is_last else "│   ")
-                result.extend(self.tree_traverse(
-                    normalized_path + item, 
-                    next_prefix, 
-                    depth, 
-                    current_depth + 1
-                ))
-        
-        return result
+                stack.append((node.child_by_label(label), next_prefix, level + 1, 0))
     
+    @timed_iter
+    @reading
+    def iter_du(self, path=".", max_depth=-1):
+        # (путь, объем, файлов) для директорий до глубины max_depth; объемы уже посчитаны в узлах
+        node = self._lookup(self.normalize_path(path))
+        if node is None:
+            return None
+        if not node.is_dir():
+            return iter(((node_path(node), node.blob.size, 1),))
+        return self._read_locked(self._du_walk(node, max_depth))
+
+    def _du_walk(self, start, max_depth):
+        # Порядок du: сначала поддиректории, затем сама директория
+        stack = [(start, node_path(start), 0, False)]
+        while stack:
+            node, path, depth, visited = stack.pop()
+            if visited or depth == max_depth:
+                yield path, node.size, node.files
+                continue
+            stack.append((node, path, depth, True))
+            prefix = path.rstrip("/") + "/"
+            subdirs = sorted((name for name, child in node.children.items() if child.is_dir()), reverse=True)
+            stack.extend((node.children[name], prefix + name, depth + 1, False) for name in subdirs)
+
+    @reading
+    def usage(self):
+        return VFSUsage(self.root.files, self.root.size, len(self.blobs.blobs), self.blobs.size,
+                        self.blobs.resident, self.cache.used, self.cache.max_bytes, len(self.lowers))
+
+    @timed
+    @writing
+    def build_trigram_index(self):
+        index = self.index
+        if index.trigrams is None:
+            index.trigrams = {}
+            for path, node in self._walk():
+                if not node.is_dir():
+                    self._index_file(node)
+        return len(index.blob_nodes)
+
+    @timed
+    @reading
+    def find(self, path=".", name=None, kind=None, min_depth=0, max_depth=-1):
+        # Пути узлов под path; kind - "f" или "d". С именем кандидаты берутся из индекса имен,
+        # без него - обход поддерева. None, если path не существует
+        start = self._lookup(self.normalize_path(path))
+        if start is None:
+            return None
+        if not start.is_dir():
+            matches = min_depth == 0 and kind != "d" and (name is None or fnmatch.fnmatchcase(start.name, name))
+            return iter((node_path(start),) if matches else ())
+        
+        if name is not None:
+            self._expand()
+            found = []
+            for node in self.index.match_names(name):
+                if kind is not None and node.is_dir() != (kind == "d"):
+                    continue
+                depth = node_depth(node, start)
+                if depth >= max(min_depth, 1) and (max_depth < 0 or depth <= max_depth):
+                    found.append(node_path(node) + ("/" if node.is_dir() else ""))
+            if min_depth == 0 and kind != "f" and start is not self.root and fnmatch.fnmatchcase(start.name, name):
+                found.append(node_path(start) + "/")
+            return iter(sorted(found))
+        return self._read_locked(self._find_walk(start, kind, min_depth, max_depth))
+
+    def _find_walk(self, start, kind, min_depth, max_depth):
+        # Обход в глубину в порядке find: директория, затем ее содержимое
+        base = node_path(start).rstrip("/") + "/"
+        if min_depth == 0 and kind != "f":
+            yield base
+        if max_depth == 0:
+            return
+        stack = [(start, base, 1, 0)]
+        while stack:
+            node, prefix, depth, index = stack.pop()
+            labels = node.sorted_labels()
+            if index >= len(labels):
+                continue
+            stack.append((node, prefix, depth, index + 1))
+            label = labels[index]
+            child = node.child_by_label(label)
+            if depth >= min_depth and (kind is None or child.is_dir() == (kind == "d")):
+                yield prefix + label
+            if child.is_dir() and (max_depth < 0 or depth < max_depth):
+                stack.append((child, prefix + label, depth + 1, 0))
+
+    GREP_PARALLEL_BYTES = 4 * 1024 * 1024
+
+    @timed
+    def grep(self, pattern, path=".", ignore_case=False):
+        # Совпадения (путь, номер строки, строка), упорядоченные по пути. Большие объемы
+        # делятся между процессами; None, если path не существует
+        flags = re.IGNORECASE if ignore_case else 0
+        regex = re.compile(pattern, flags)
+        prefilter = None if any(token in pattern for token in PREFILTER_UNSAFE) \
+            else re.compile(pattern, flags | re.MULTILINE)
+        files = self._grep_files(pattern, path)
+        if files is None:
+            return None
+        
+        workers = os.cpu_count() or 1
+        total = sum(node.blob.size for path, node in files)
+        if workers > 1 and len(files) > 1 and total >= self.GREP_PARALLEL_BYTES \
+                and "fork" in multiprocessing.get_all_start_methods():
+            return self._grep_parallel(files, regex, prefilter, workers)
+        return [(path, line_num, line) for path, node in files
+                for line_num, line in grep_text(content_text(self._content(node)), regex, prefilter)]
+
+    def _grep_parallel(self, files, regex, prefilter, workers):
+        # Воркеры получают список файлов через fork, а не через pickle
+        step = max(1, -(-len(files) // (workers * 4)))
+        starts = range(0, len(files), step)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_init_grep_worker, initargs=((files, regex, prefilter),)) as pool:
+            return [match for chunk in pool.map(_grep_range, starts, itertools.repeat(step, len(starts)))
+                    for match in chunk]
+
+    @reading
+    def _grep_files(self, pattern, path):
+        start = self._lookup(self.normalize_path(path))
+        if start is None:
+            return None
+        if not start.is_dir():
+            return [(node_path(start), start)]
+        
+        blobs = self.index.candidates(regex_literals(pattern))
+        if blobs is not None:
+            files = [(node_path(node), node) for blob in blobs for node in self.index.blob_nodes.get(blob, ())
+                     if start is self.root or node_depth(node, start) > 0]
+        else:
+            files = []
+            stack = [(start, node_path(start).rstrip("/") + "/")]
+            while stack:
+                node, prefix = stack.pop()
+                for name, child in node.children.items():
+                    if child.is_dir():
+                        stack.append((child, prefix + name + "/"))
+                    else:
+                        files.append((prefix + name, child))
+        files.sort(key=lambda item: item[0])
+        return files
+
+    @timed
+    @writing
     def create_file(self, file_path, content=""):
         normalized_path = self.normalize_path(file_path)
         if normalized_path.endswith("/"):
             return False, "Невозможно создать файл: путь указывает на директорию"
         
-        if normalized_path in self.filesystem:
+        if self._lookup(normalized_path) is not None:
             return False, f"Файл '{normalized_path}' уже существует"
         
-        parent_dir = "/".join(normalized_path.split("/")[:-1])
-        if parent_dir and not parent_dir.endswith("/"):
-            parent_dir += "/"
-        
-        if parent_dir and parent_dir != "/" and parent_dir not in self.filesystem:
-            current_path = ""
-            for part in parent_dir.split("/"):
-                if not part:
-                    continue
-                current_path += part + "/"
-                if current_path not in self.filesystem:
-                    self.filesystem[current_path] = None
+        parts = split_path(normalized_path)
+        parent = self._ensure_dir(parts[:-1])
+        if parent is None:
+            return False, f"Невозможно создать файл: '{normalized_path}' находится не в директории"
         
-        self.filesystem[normalized_path] = content
+        self._put_file(parent, parts[-1], content)
+        self._log(JOURNAL_CREATE, normalized_path, b"t" if isinstance(content, str) else b"b", content)
         return True, f"Файл '{normalized_path}' создан"
+
+    @timed
+    @writing
+    def write_file(self, file_path, content, append=False):
+        # Запись с заменой содержимого или дописыванием в конец (перенаправление > и >>)
+        normalized_path = self.normalize_path(file_path)
+        if normalized_path.endswith("/"):
+            return False, "Невозможно записать файл: путь указывает на директорию"
+        
+        node = self._lookup(normalized_path)
+        if node is not None and node.is_dir():
+            return False, f"'{normalized_path}' является директорией"
+        
+        parts = split_path(normalized_path)
+        parent = self._ensure_dir(parts[:-1])
+        if parent is None:
+            return False, f"Невозможно записать файл: '{normalized_path}' находится не в директории"
+        
+        data = content
+        if append and node is not None:
+            old = self._content(node)
+            if isinstance(old, str) and isinstance(content, str):
+                data = old + content
+            else:
+                # Старое содержимое из снимка или mmap - memoryview: текст снова становится str
+                data = decode_content((old.encode('utf-8') if isinstance(old, str) else bytes(old)) +
+                                      (content.encode('utf-8') if isinstance(content, str) else bytes(content)))
+        self._put_file(parent, parts[-1], data)
+        self._log(JOURNAL_APPEND if append else JOURNAL_WRITE, normalized_path,
+                  b"t" if isinstance(content, str) else b"b", content)
+        return True, f"Файл '{normalized_path}' записан"
     
+    @timed
+    @reading
     def file_exists(self, file_path):
         normalized_path = self.normalize_path(file_path)
-        return normalized_path in self.filesystem and not normalized_path.endswith("/")
+        node = self._lookup(normalized_path)
+        return node is not None and not node.is_dir() and not normalized_path.endswith("/")
 
+    @timed
+    @reading
     def dir_exists(self, dir_path):
-        normalized_path = self.normalize_path(dir_path)
-        if not normalized_path.endswith("/"):
-            normalized_path += "/"
-        return normalized_path in self.filesystem
+        node = self._lookup(self.normalize_path(dir_path))
+        return node is not None and node.is_dir()
 
+    @timed
+    @writing
     def copy_file(self, src_path, dst_path):
         src_normalized = self.normalize_path(src_path)
         dst_normalized = self.normalize_path(dst_path)
         
-        if not self.file_exists(src_normalized):
+        src_node = self._lookup(src_normalized)
+        if src_node is None or src_node.is_dir() or src_normalized.endswith("/"):
+            if src_node is not None and src_node.is_dir():
+                return False, "Невозможно скопировать директорию (используйте cp -r)"
             return False, f"Исходный файл '{src_path}' не существует"
         
-        if src_normalized.endswith("/"):
-            return False, "Невозможно скопировать директорию"
+        dst_node = self._lookup(dst_normalized)
+        if dst_normalized.endswith("/") or (dst_node is not None and dst_node.is_dir()):
+            dst_normalized = dst_normalized.rstrip('/') + '/' + src_node.name
+            dst_node = self._lookup(dst_normalized)
         
-        if dst_normalized.endswith("/") or self.dir_exists(dst_normalized):
-            filename = src_normalized.split("/")[-1]
-            dst_normalized = dst_normalized.rstrip('/') + '/' + filename
-        
-        if dst_normalized.endswith("/"):
+        if dst_node is not None and dst_node.is_dir():
             return False, "Целевой путь указывает на директорию"
         
-        parent_dir = "/".join(dst_normalized.split("/")[:-1])
-        if parent_dir and not parent_dir.endswith("/"):
-            parent_dir += "/"
-        
-        if parent_dir and parent_dir != "/" and parent_dir not in self.filesystem:
-            current_path = ""
-            for part in parent_dir.split("/"):
-                if not part:
-                    continue
-                current_path += part + "/"
-                if current_path not in self.filesystem:
-                    self.filesystem[current_path] = None
+        parts = split_path(dst_normalized)
+        parent = self._ensure_dir(parts[:-1])
+        if parent is None:
+            return False, f"Невозможно скопировать: '{dst_normalized}' находится не в директории"
         
-        src_content = self.filesystem[src_normalized]
-        self.filesystem[dst_normalized] = src_content
+        self._link_file(parent, parts[-1], src_node)
+        self._log(JOURNAL_COPY, src_normalized, dst_normalized)
         return True, f"Файл '{src_path}' скопирован в '{dst_normalized}'"
+
+    @timed
+    @writing
+    def copy_tree(self, src_path, dst_path):
+        src_normalized = self.normalize_path(src_path)
+        dst_normalized = self.normalize_path(dst_path)
+        
+        src_node = self._lookup(src_normalized)
+        if src_node is None:
+            return False, f"Источник '{src_path}' не существует"
+        if not src_node.is_dir():
+            return self.copy_file(src_path, dst_path)
+        if src_node is self.root:
+            return False, "Невозможно скопировать корневую директорию"
+        
+        dst_requested = dst_normalized
+        dst_node = self._lookup(dst_normalized)
+        if dst_node is not None and dst_node.is_dir():
+            dst_normalized = dst_normalized.rstrip('/') + '/' + src_node.name
+        
+        dst_parts = split_path(dst_normalized)
+        src_parts = split_path(src_normalized)
+        if dst_parts[:len(src_parts)] == src_parts:
+            return False, "Невозможно скопировать директорию внутрь самой себя"
+        
+        # Конфликты проверяются до изменения дерева: в журнал попадает только
+        # копирование, которое выполнится целиком
+        conflict = self._copy_conflict(src_node, dst_parts, dst_normalized)
+        if conflict:
+            return False, conflict
+        self._log(JOURNAL_COPY_TREE, src_normalized, dst_requested)
+        
+        copied = 0
+        stack = [(src_node, self._ensure_dir(dst_parts))]
+        while stack:
+            src_dir, target = stack.pop()
+            for name, child in list(src_dir.children.items()):
+                existing = target.children.get(name)
+                if child.is_dir():
+                    if existing is None:
+                        existing = target.add(name, DirNode(name, target))
+                        self.index.add(existing)
+                    stack.append((child, existing))
+                else:
+                    self._link_file(target, name, child)
+                    copied += 1
+        return True, f"Директория '{src_path}' скопирована в '{dst_normalized}' (файлов: {copied})"
     
-    def save_to_zip(self, zip_path):
-        try:
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for path, content in self.filesystem.items():
-                    if path.endswith('/'):  
-                        zipf.writestr(path, '')
-                    else: 
-                        if content and content.startswith("base64:"):
-                            binary_data = base64.b64decode(content[7:])
-                            zipf.writestr(path, binary_data)
-                        else:
-                            zipf.writestr(path, content or '')
-            return True, f"VFS сохранена в {zip_path}"
+    def _copy_conflict(self, src_node, dst_parts, dst_normalized):
+        node = self.root
+        for part in dst_parts:
+            node = node.children.get(part)
+            if node is None:
+                return None
+            if not node.is_dir():
+                return f"Целевой путь '{dst_normalized}' не является директорией"
+        stack = [(src_node, node)]
+        while stack:
+            src_dir, target = stack.pop()
+            for name, child in src_dir.children.items():
+                existing = target.children.get(name)
+                if existing is None:
+                    continue
+                if child.is_dir():
+                    if not existing.is_dir():
+                        return f"Конфликт: '{name}' в '{dst_normalized}' является файлом"
+                    stack.append((child, existing))
+                elif existing.is_dir():
+                    return f"Конфликт: '{name}' в '{dst_normalized}' является директорией"
+        return None
+
+    @timed
+    @writing
+    def save_to_zip(self, zip_path, compresslevel=DEFAULT_COMPRESSLEVEL, workers=None, delta=False):
+        # Пишем во временный файл: ленивые файлы могут читаться из того же архива.
+        # С delta=True сохраняется только верхний слой overlay-VFS
+        if delta and not self.lowers:
+            return False, "Дельта сохраняется только для VFS, смонтированной поверх слоев (mount)"
+        tmp_path = zip_path + ".tmp"
+        compress_type = zipfile.ZIP_STORED if compresslevel == 0 else zipfile.ZIP_DEFLATED
+        workers = workers or os.cpu_count() or 1
+        copied = 0
+        compressed = 0
+        try:
+            with zipfile.ZipFile(tmp_path, 'w', compress_type) as zipf, \
+                    ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+                window = 4 * workers
+                for path, node in (self._delta_entries() if delta else self._walk()):
+                    if node is None:
+                        pending.append((path, None, pool.submit(compress_member, b"", compresslevel)))
+                    elif node.is_dir():
+                        pending.append((path, None, None))
+                    elif node.origin is not None and node.origin.info.compress_type == compress_type:
+                        pending.append((path, node.origin, None))
+                    else:
+                        # Измененные файлы сжимаются в пуле потоков, запись идет по порядку
+                        data = self._content(node, cached=False) or b""
+                        pending.append((path, None, pool.submit(compress_member, data, compresslevel)))
+                    while len(pending) > window:
+                        compressed, copied = self._write_pending(zipf, pending.popleft(), compressed, copied)
+                while pending:
+                    compressed, copied = self._write_pending(zipf, pending.popleft(), compressed, copied)
+            if delta:
+                os.replace(tmp_path, zip_path)
+                return True, (f"Верхний слой VFS сохранен в {zip_path} "
+                              f"(сжато файлов: {compressed}, скопировано без пересжатия: {copied})")
+            # Windows не дает заменить открытый файл: свой архив на месте сохраняемого
+            # закрывается до замены и открывается заново после нее (или после ошибки)
+            closed = self._close_archives(zip_path)
+            try:
+                os.replace(tmp_path, zip_path)
+            except Exception:
+                if closed:
+                    self._rebind_origins(zip_path, closed, saved=False)
+                raise
+            self._rebind_origins(zip_path, closed)
+            self._saved_base(zip_path)
+            return True, (f"VFS сохранена в {zip_path} "
+                          f"(сжато файлов: {compressed}, скопировано без пересжатия: {copied})")
         except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
             return False, f"Ошибка сохранения VFS: {str(e)}"
+
+    def _delta_entries(self):
+        # Отличия от слоев: новые и измененные файлы, новые директории и whiteout-метки
+        # для удаленных имен (None вместо узла). Неоткрытые директории целиком из слоев
+        stack = [(self.root, "")]
+        while stack:
+            node, prefix = stack.pop()
+            if isinstance(node, OverlayDirNode):
+                if node.owner is not None:
+                    continue
+                lower = merge_layers(node.lowers)
+            else:
+                lower = {}
+            for name, child in node.children.items():
+                below = lower.get(name)
+                if child.is_dir():
+                    if not isinstance(child, OverlayDirNode):
+                        yield prefix + name + "/", child
+                        if isinstance(below, list):
+                            yield prefix + name + "/" + OPAQUE_MARKER, None
+                    stack.append((child, prefix + name + "/"))
+                elif not isinstance(below, FileNode) or below.blob.key != child.blob.key:
+                    yield prefix + name, child
+            for name in lower.keys() - node.children.keys():
+                yield prefix + WHITEOUT_PREFIX + name, None
+
+    def _write_pending(self, zipf, item, compressed, copied):
+        path, origin, future = item
+        if origin is None and future is None:
+            zipf.writestr(path, '')
+            return compressed, copied
+        
+        zinfo = zipfile.ZipInfo(path, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o600 << 16
+        if origin is not None:
+            zinfo.date_time = origin.info.date_time
+            zinfo.external_attr = origin.info.external_attr
+            zinfo.compress_type = origin.info.compress_type
+            zinfo.CRC = origin.info.CRC
+            zinfo.file_size = origin.info.file_size
+            raw = read_raw_member(origin.zip_ref, origin.info)
+            copied += 1
+        else:
+            zinfo.compress_type, zinfo.CRC, zinfo.file_size, raw = future.result()
+            compressed += 1
+        zinfo.compress_size = len(raw)
+        write_raw_member(zipf, zinfo, raw)
+        return compressed, copied
+
+    def _open_archive(self, zip_path, use_mmap):
+        zip_ref = zipfile.ZipFile(zip_path, 'r')
+        mapped = None
+        if use_mmap:
+            with open(zip_path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._archives.append((zip_ref, mapped))
+        return zip_ref, mapped
+
+    def _close_archives(self, zip_path):
+        # Закрывает свои архивы с этим путем. Архивы слоев не трогаются: их делят другие VFS
+        path = os.path.abspath(zip_path)
+        closed = [archive for archive in self._archives if os.path.abspath(archive[0].filename) == path]
+        for archive in closed:
+            self._close_archive(archive)
+        if closed:
+            self.cache.clear()
+        return closed
+
+    def _rebind_origins(self, zip_path, closed=(), saved=True):
+        # После сохранения все файлы ссылаются на новый архив и считаются неизмененными,
+        # ленивое содержимое закрытых архивов читается из нового. Если архив не был заменен
+        # (saved=False), закрытые архивы открываются снова с теми же членами
+        closed_refs = {zip_ref for zip_ref, mapped in closed}
+        closed_mapped = {mapped for zip_ref, mapped in closed if mapped is not None}
+        zip_ref, mapped = self._open_archive(zip_path, bool(closed_mapped))
+        used = {zip_ref}
+        for path, node in self._walk():
+            if node.is_dir():
+                continue
+            origin = node.origin
+            if saved:
+                info = zip_ref.NameToInfo.get(path)
+                node.origin = ZipMemberSource(zip_ref, info) if info is not None else None
+            elif origin is not None and origin.zip_ref in closed_refs:
+                node.origin = ZipMemberSource(zip_ref, origin.info)
+            if node.origin is not None:
+                used.add(node.origin.zip_ref)
+            content = node.blob.content
+            if isinstance(content, MappedMemberSource) and content.mapped in closed_mapped \
+                    or isinstance(content, ZipMemberSource) and content.zip_ref in closed_refs:
+                info = zip_ref.NameToInfo[path] if saved else content.info
+                if mapped is not None and info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+                    self._rebind_blob(node.blob, MappedMemberSource(mapped, info))
+                else:
+                    self._rebind_blob(node.blob, ZipMemberSource(zip_ref, info))
+                content = node.blob.content
+            if isinstance(content, ZipMemberSource):
+                used.add(content.zip_ref)
+            elif isinstance(content, MappedMemberSource):
+                used.add(content.mapped)
+        # Прежние архивы, на которые больше ничего не ссылается, закрываются
+        for archive in list(self._archives):
+            if archive[0] not in used and archive[1] not in used:
+                self._close_archive(archive)
+
+    def _close_archive(self, archive):
+        self._archives.remove(archive)
+        zip_ref, mapped = archive
+        zip_ref.close()
+        if mapped is not None:
+            try:
+                mapped.close()
+            except BufferError:
+                # Отображение освободится вместе с последним memoryview на него
+                pass
+
+    def _rebind_blob(self, blob, source):
+        # Ключ ленивого blob'а - его источник, поэтому blob перерегистрируется под новым
+        blobs = self.blobs.blobs
+        if blobs.get(blob.key) is blob:
+            del blobs[blob.key]
+        blob.key = blob.content = source
+        blobs[source] = blob
+
+    @reading
+    def dirty_count(self):
+        return sum(1 for path, node in self._walk() if not node.is_dir() and node.origin is None)
     
 
-class TerminalEmulator:
-    def __init__(self, root, script_path=None, vfs_path=None):
-        self.root = root
+class VFSHandle(VFS):
+    # Доступ к общей VFS со своей рабочей директорией: несколько потоков или сессий
+    # работают с одним деревом, не мешая друг другу cd. Остальное состояние берется из vfs
+    LOCAL_ATTRS = frozenset(("vfs", "curr_dir", "_rel_paths", "_rel_paths_dir"))
+
+    def __init__(self, vfs, curr_dir="/"):
+        object.__setattr__(self, "vfs", vfs)
+        object.__setattr__(self, "curr_dir", curr_dir)
+        object.__setattr__(self, "_rel_paths", {})
+        object.__setattr__(self, "_rel_paths_dir", curr_dir)
+
+    def __getattr__(self, name):
+        return getattr(self.vfs, name)
+
+    def __setattr__(self, name, value):
+        if name in self.LOCAL_ATTRS:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.vfs, name, value)
+
+    def handle(self, curr_dir=None):
+        return self.vfs.handle(self.curr_dir if curr_dir is None else curr_dir)
+
+
+# Сводка df: объем файлов, различного содержимого (копии не считаются) и его части в памяти
+VFSUsage = namedtuple("VFSUsage", "files size blobs unique resident cache_used cache_limit layers")
+
+# Нижние слои overlay: архив загружается один раз на процесс и делится всеми VFS над ним
+_layers = {}
+_layers_lock = threading.Lock()
+
+
+def load_layer(path):
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _layers_lock:
+        layer = _layers.get(key)
+        if layer is None:
+            layer = _layers[key] = VFS(path, lazy=True)
+    return layer
+
+
+ENV_VAR_PATTERN = re.compile(r'\$(\w+)')
+
+# Операторы конвейера и перенаправления распознаются только как отдельные слова
+PIPELINE_TOKENS = frozenset(("|", ">", ">>"))
+
+# Сколько вариантов дополнения собирается не более чем за одно нажатие Tab
+COMPLETION_LIMIT = 100
+
+# Имя команды -> имя метода Shell, заполняется декоратором command
+COMMANDS = {}
+
+
+def command(name):
+    def decorator(func):
+        COMMANDS[name] = func.__name__
+        return func
+    return decorator
+
+
+ParsedCommand = namedtuple("ParsedCommand", "line_num text name args needs_parse")
+CompiledScript = namedtuple("CompiledScript", "path mtime_ns size total_lines commands")
+
+_compiled_scripts = {}
+
+
+def compile_script(script_path):
+    # Разобранный скрипт кэшируется по пути и mtime, повторный запуск не читает файл
+    stat = os.stat(script_path)
+    key = os.path.abspath(script_path)
+    compiled = _compiled_scripts.get(key)
+    if compiled is not None and compiled.mtime_ns == stat.st_mtime_ns and compiled.size == stat.st_size:
+        return compiled
+
+    with open(script_path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+
+    commands = []
+    for line_num, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        # Строки с $VAR и конвейеры разбираются при выполнении, остальные - один раз здесь
+        parts = line.split()
+        needs_parse = "$" in line or not PIPELINE_TOKENS.isdisjoint(parts)
+        if needs_parse:
+            parts = []
+        commands.append(ParsedCommand(line_num, line, parts[0] if parts else None,
+                                      tuple(parts[1:]), needs_parse))
+
+    compiled = CompiledScript(key, stat.st_mtime_ns, stat.st_size, len(lines), commands)
+    _compiled_scripts[key] = compiled
+    return compiled
+
+
+class Shell:
+    # Набор команд терминала без привязки к GUI: вывод пишется в поток output.
+    # Если передана готовая vfs, оболочка работает с ней совместно с другими (сессии сервера);
+    # переменные окружения у каждой оболочки свои и в os.environ не пишутся
+    def __init__(self, vfs_path=None, lazy=False, cache_bytes=VFS.DEFAULT_CACHE_BYTES, output=None,
+                 profile_path=None, journal_path=None, vfs=None, env=None, trigrams=False, layers=None):
         self.vfs_path = vfs_path or os.getcwd()
-        self.root.title("VFS Terminal Emulator")
+        self.output = output if output is not None else sys.stdout
+        self.exited = False
+        self._script_cancel = threading.Event()
+        self.commands = {name: getattr(self, method) for name, method in COMMANDS.items()}
+        self.command_names = sorted(self.commands)
+        self.stats = vfs.stats if vfs is not None and vfs.stats is not None else Stats()
+        self.profile_path = profile_path
+        self._profiler = None
+        self._profiling = False
+        self.env = dict(os.environ if env is None else env)
+        self.owns_vfs = vfs is None
+        self.failures = 0
+        self._pipe = threading.local()
 
-        try:
-            self.vfs = VFS(vfs_path)
-        except Exception as e:
-            self.print_output(f"Ошибка VFS: {str(e)}")
-            self.root.quit()
-            return 
-        
-        self.script_path = script_path
-        main_frame = tk.Frame(self.root)
-        main_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
-        
-        self.output_area = scrolledtext.ScrolledText(main_frame, height=20)
-        self.output_area.pack(fill=tk.BOTH, expand=True)
-        self.output_area.config(state=tk.DISABLED)
-        
-        input_frame = tk.Frame(main_frame)
-        input_frame.pack(fill=tk.X, pady=(5, 0))
+        if vfs is not None:
+            self.vfs = vfs
+        else:
+            try:
+                self.vfs = VFS(vfs_path, lazy=lazy, cache_bytes=cache_bytes, stats=self.stats,
+                               journal_path=journal_path, trigrams=trigrams, layers=layers)
+            except Exception as e:
+                self.vfs = None
+                self.print_error(f"Ошибка VFS: {str(e)}")
+                return
 
-        os.environ["DATE"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        os.environ["PWD"] = self.vfs.get_curr_path()
-        os.environ["USER"] = os.getlogin() if hasattr(os, 'getlogin') else "user"
-        os.environ["HOME"] = "/"
+        self.env["DATE"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.env["PWD"] = self.vfs.get_curr_path()
+        if env is None or "USER" not in self.env:
+            self.env["USER"] = current_user()
+        self.env["HOME"] = "/"
         
         self.prompt_text = self.parse_env_var("$USER@VFS")
-        self.prompt_label = tk.Label(input_frame, text=self.prompt_text)
-        self.prompt_label.pack(side=tk.LEFT)
-        
-        self.input_field = tk.Entry(input_frame, relief=tk.FLAT)
-        self.input_field.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(5, 0))
-        self.input_field.focus()
-        
-        self.input_field.bind('<Return>', self.process_command)
-       
-        self.print_output("")
-        
-        if script_path:
-            self.startup_script()
-    
-    
             
     def repl(self, match):
         name = match.group(1)
-        return os.environ.get(name, '')
+        return self.env.get(name, '')
             
     def parse_env_var(self, command):
-        pattern = r'\$(\w+)'
-        return re.sub(pattern, self.repl, command)
-    
+        return ENV_VAR_PATTERN.sub(self.repl, command)
+
+    def register_command(self, name, handler):
+        if name not in self.commands:
+            bisect.insort(self.command_names, name)
+        self.commands[name] = handler
+
+    def complete(self, line, limit=COMPLETION_LIMIT):
+        # Дополнение последнего слова строки: первое слово команды (и слово после |) -
+        # имя команды, остальные - путь VFS. Возвращает новую строку и список вариантов
+        words = line.split()
+        word = "" if not words or line[-1].isspace() else words[-1]
+        previous = words[:-1] if word else words
+        if not previous or previous[-1] == "|":
+            # Общий префикс считается по всем совпадениям, limit ограничивает только список
+            names = self.command_names
+            start, end = prefix_range(names, word)
+            candidates = names[start:min(end, start + limit)]
+            common = os.path.commonprefix([names[start], names[end - 1]]) if candidates else ""
+            count = end - start
+        elif self.vfs is not None:
+            candidates, common, count = self.vfs.complete_path(word, limit)
+        else:
+            candidates = []
+        if not candidates:
+            return line, []
+        
+        if count == 1 and not common.endswith("/"):
+            common += " "
+        return line[:len(line) - len(word)] + common, candidates
+
     def print_output(self, text):
-        self.output_area.config(state=tk.NORMAL)
-        self.output_area.insert(tk.END, text + "\n")
-        self.output_area.config(state=tk.DISABLED)
-        self.output_area.see(tk.END)
-    
+        if self._captures:
+            self._captures[-1].append(text)
+            return
+        self.output.write(text + "\n")
+
+    # Состояние конвейера свое у каждого потока: вывод GUI не попадает в перенаправление
+    # скрипта, выполняемого в фоне, и наоборот
+    @property
+    def _stdin(self):
+        return getattr(self._pipe, "stdin", None)
+
+    @_stdin.setter
+    def _stdin(self, value):
+        self._pipe.stdin = value
+
+    @property
+    def _captures(self):
+        captures = getattr(self._pipe, "captures", None)
+        if captures is None:
+            captures = self._pipe.captures = []
+        return captures
+
+    @_captures.setter
+    def _captures(self, value):
+        self._pipe.captures = value
+
+    def print_notice(self, text):
+        # Служебные сообщения и ошибки не попадают в конвейер и в файл перенаправления
+        captures, self._captures = self._captures, []
+        try:
+            self.print_output(text)
+        finally:
+            self._captures = captures
+
+    def print_error(self, text):
+        # Каждая ошибка считается: по failures определяется код завершения скрипта в batch
+        self.failures += 1
+        self.print_notice(text)
+
+    def clear_output(self):
+        pass
+
+    def request_exit(self):
+        self.exited = True
+        self._script_cancel.set()
+
+    def close(self):
+        if self.vfs is not None and self.owns_vfs:
+            self.vfs.close()
+
+    def report_progress(self, script_path, line_num, total):
+        pass
+
     def update_environment(self):
-        os.environ["PWD"] = self.vfs.get_curr_path()
+        self.env["PWD"] = self.vfs.get_curr_path()
 
-    def startup_script(self):
-        if not self.script_path or not os.path.exists(self.script_path):
-            self.print_output(f"Ошибка: скрипт '{self.script_path}' не найден")
+    def start_script(self, script_path):
+        self.run_script(script_path)
+
+    def cancel_script(self):
+        self._script_cancel.set()
+
+    @command("exit")
+    def cmd_exit(self, args):
+        self.request_exit()
+
+    @command("cancel")
+    def cmd_cancel(self, args):
+        self.cancel_script()
+
+    @command("echo")
+    def cmd_echo(self, args):
+        return iter((" ".join(args).rstrip('"').lstrip('"'),))
+
+    @command("cls")
+    def cmd_cls(self, args):
+        self.clear_output()
+
+    @command("time")
+    def cmd_time(self, args):
+        if not args:
+            self.print_error("Использование: time <команда> [аргументы]")
             return
         
-        self.print_output(f"Выполнение скрипта '{self.script_path}'")
+        before = self.stats.snapshot()
+        start = time.perf_counter()
+        self.execute(args[0], args[1:])
+        elapsed = time.perf_counter() - start
+        
+        self.print_output(f"time: {' '.join(args)}: {elapsed * 1e3:.3f} мс")
+        for name, count, total in self.stats.diff(before):
+            if name.startswith("cmd."):
+                continue
+            self.print_output(f"  {name}: {count} выз., {total * 1e3:.3f} мс")
+
+    @command("stats")
+    def cmd_stats(self, args):
+        if args and args[0] == "reset":
+            self.stats.reset()
+            self.print_output("Статистика сброшена")
+            return
+        if not self.stats.entries:
+            self.print_output("Статистика пуста")
+            return
+        for line in self.stats.report():
+            self.print_output(line)
+
+    def run_script(self, script_path):
+        return self.run_profiled(self._run_script, script_path)
+
+    def run_profiled(self, func, *args):
+        # Профиль cProfile накапливается за все прогоны и перезаписывается после каждого
+        if not self.profile_path or self._profiling:
+            return func(*args)
+        if self._profiler is None:
+            self._profiler = cProfile.Profile()
+        self._profiling = True
+        self._profiler.enable()
+        try:
+            return func(*args)
+        finally:
+            self._profiler.disable()
+            self._profiling = False
+            self._profiler.dump_stats(self.profile_path)
+
+    def _run_script(self, script_path):
+        if not script_path or not os.path.exists(script_path):
+            self.print_error(f"Ошибка: скрипт '{script_path}' не найден")
+            return
+        
+        self.print_output(f"Выполнение скрипта '{script_path}'")
         
         try:
-            with open(self.script_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for line_num, line in enumerate(lines, 1):
-                    line = line.strip()
-                    if not line or line.startswith('#'):
-                        continue
-                    
-                    self.print_output(f"{self.prompt_text}> {line}")
-                    try:
-                        self.command_reader(line)
-                    except Exception as e:
-                        self.print_output(f"Строка {line_num}: ошибка - {str(e)}")
-                        continue
+            script = compile_script(script_path)
+            for parsed in script.commands:
+                if self._script_cancel.is_set():
+                    self.print_output(f"Выполнение скрипта '{script_path}' прервано на строке {parsed.line_num}")
+                    break
+                self.report_progress(script_path, parsed.line_num, script.total_lines)
+                
+                self.print_output(f"{self.prompt_text}> {parsed.text}")
+                try:
+                    if parsed.needs_parse:
+                        self.command_reader(parsed.text)
+                    else:
+                        self.execute(parsed.name, list(parsed.args))
+                except Exception as e:
+                    self.print_error(f"Строка {parsed.line_num}: ошибка - {str(e)}")
+                    continue
 
         except Exception as e:
-            self.print_output(f'Ошибка чтения скрипта: {str(e)}')
+            self.print_error(f'Ошибка чтения скрипта: {str(e)}')
         
         self.print_output("Завершение выполнения скрипта")
         self.print_output("")
     
 
+    @command("touch")
     def cmd_touch(self, args):
         if not args:
-            self.print_output("Введите имя файла")
+            self.print_error("Введите имя файла")
             return
         
         for file_path in args:
@@ -378,52 +2572,151 @@ class TerminalEmulator:
             if success:
                 self.print_output(message)
             else:
-                self.print_output(f"Ошибка touch: {message}")
+                self.print_error(f"Ошибка touch: {message}")
 
+    @command("cp")
     def cmd_cp(self, args):
+        recursive = bool(args) and args[0] in ("-r", "-R")
+        if recursive:
+            args = args[1:]
         if len(args) < 2:
-            self.print_output("Введите название файла и новой директории")
+            self.print_error("Введите название файла и новой директории")
             return
         
         src_path = args[0]
         dst_path = args[1]
         
-        success, message = self.vfs.copy_file(src_path, dst_path)
+        if recursive:
+            success, message = self.vfs.copy_tree(src_path, dst_path)
+        else:
+            success, message = self.vfs.copy_file(src_path, dst_path)
         if success:
             self.print_output(message)
         else:
-            self.print_output(f"Ошибка cp: {message}")
+            self.print_error(f"Ошибка cp: {message}")
 
+    @command("savevfs")
     def cmd_savevfs(self, args):
+        compresslevel = VFS.DEFAULT_COMPRESSLEVEL
+        delta = False
+        while args and args[0].startswith("-"):
+            if args[0] == "--stored":
+                compresslevel = 0
+            elif args[0] == "--delta":
+                delta = True
+            elif len(args[0]) == 2 and args[0][1].isdigit():
+                compresslevel = int(args[0][1])
+            else:
+                self.print_error(f"savevfs: неизвестный параметр '{args[0]}'")
+                return
+            args = args[1:]
         if not args:
-            self.print_output("Введите путь к zip-архиву")
+            self.print_error(f"Использование: savevfs [-0..-9 | --stored] [--delta] <путь_к_zip-архиву | путь{SNAPSHOT_EXT}>")
             return
         
         vfs_path = args[0]
         try:
-            success, message = self.vfs.save_to_zip(vfs_path)
+            if vfs_path.endswith(SNAPSHOT_EXT) and not delta:
+                success, message = self.vfs.save_snapshot(vfs_path)
+            else:
+                success, message = self.vfs.save_to_zip(vfs_path, compresslevel, delta=delta)
             if success:
                 self.print_output(message)
             else:
-                self.print_output(f"Ошибка: {message}")
+                self.print_error(f"Ошибка: {message}")
         except Exception as e:
-            self.print_output(f"Ошибка сохранения VFS: {str(e)}")
+            self.print_error(f"Ошибка сохранения VFS: {str(e)}")
     
     
+    @command("journal")
+    def cmd_journal(self, args):
+        journal = self.vfs.journal
+        if journal is None:
+            self.print_error("Журнал не подключен (запустите с --journal <файл>)")
+            return
+        if not args:
+            self.print_output(f"Журнал {journal.path}: записей {journal.records}, "
+                              f"размер {journal.size()} байт, не синхронизировано {journal.pending}")
+        elif args[0] == "sync":
+            journal.sync()
+            self.print_output("Журнал синхронизирован")
+        elif args[0] == "compact":
+            success, message = self.vfs.compact_journal()
+            if success:
+                self.print_output(message)
+            else:
+                self.print_error(f"Ошибка journal: {message}")
+        else:
+            self.print_error("Использование: journal [sync | compact]")
+
+    @command("ls")
     def cmd_ls(self, args):
+        paging = self._parse_paging("ls", args)
+        if paging is None:
+            return
+        limit, offset, args = paging
         path = args[0] if args else "."
         
         try:
-            items = self.vfs.list_dir(path)
-            if not items:
-                self.print_output("Директория пуста")
-                return
-            
-            for item in items:
-                self.print_output(item)
+            items = self.vfs.iter_dir(path)
+            first = next(items, None)
+            if first is None:
+                self.print_notice("Директория пуста")
+                return
+            
+            return self._page(itertools.chain([first], items), limit, offset)
+        except Exception as e:
+            self.print_error(f"Ошибка ls: {str(e)}")
+
+    def _parse_paging(self, name, args):
+        limit = None
+        offset = 0
+        rest = []
+        i = 0
+        while i < len(args):
+            if args[i] in ("--limit", "--offset"):
+                if i + 1 >= len(args) or not args[i + 1].isdigit():
+                    self.print_error(f"{name}: {args[i]} требует неотрицательное число")
+                    return None
+                if args[i] == "--limit":
+                    limit = int(args[i + 1])
+                else:
+                    offset = int(args[i + 1])
+                i += 2
+            else:
+                rest.append(args[i])
+                i += 1
+        return limit, offset, rest
+
+    def _page(self, lines, limit, offset):
+        # Отдается только запрошенная страница, остальные строки не строятся
+        if offset:
+            lines = itertools.islice(lines, offset, None)
+        if limit is None:
+            yield from lines
+            return
+        
+        yield from itertools.islice(lines, limit)
+        if next(lines, None) is not None:
+            # Подсказка - не данные: в конвейер и в файл перенаправления она не попадает
+            self.print_notice(f"... есть еще записи, следующая страница: --offset {offset + limit}")
+
+    def _tree_page(self, path, tree_lines, limit, offset):
+        first = next(tree_lines, None)
+        if first is None:
+            yield f"{path} [пустая директория]"
+            return
+        yield path
+        yield from self._page(itertools.chain([first], tree_lines), limit, offset)
+
+    def _guarded(self, name, lines):
+        # Ошибка посреди потока строк выводится так же, как ошибка самой команды
+        try:
+            yield from lines
         except Exception as e:
-            self.print_output(f"Ошибка ls: {str(e)}")
+            self.print_error(f"Ошибка {name}: {str(e)}")
     
+    @command("cd")
     def cmd_cd(self, args):
         if not args:
             target = "/"
@@ -433,16 +2726,22 @@ class TerminalEmulator:
         try:
             success = self.vfs.change_dir(target)
             if not success:
-                self.print_output(f"cd: {target}: Нет такой директории")
+                self.print_error(f"cd: {target}: Нет такой директории")
             else:
                 self.update_environment()
         except Exception as e:
-            self.print_output(f"Ошибка cd: {str(e)}")
+            self.print_error(f"Ошибка cd: {str(e)}")
     
-    def cmd_pwd(self):
+    @command("pwd")
+    def cmd_pwd(self, args):
         self.print_output(self.vfs.get_curr_path())
     
+    @command("tree")
     def cmd_tree(self, args):
+        paging = self._parse_paging("tree", args)
+        if paging is None:
+            return
+        limit, offset, args = paging
         path = args[0] if args else "."
         depth = -1
         
@@ -451,201 +2750,632 @@ class TerminalEmulator:
                 depth = int(args[1])
                 path = args[2] if len(args) > 2 else "."
             except ValueError:
-                self.print_output("tree: неверный аргумент глубины")
+                self.print_error("tree: неверный аргумент глубины")
                 return
         
         try:
-            tree_lines = self.vfs.tree_traverse(path, depth=depth)
-            if not tree_lines:
-                self.print_output(f"{path} [пустая директория]")
-                return
-            
-            self.print_output(path)
-            for line in tree_lines:
-                self.print_output(line)
+            # Обход берет блокировку чтения на первой строке, поэтому в него не заглядываем заранее:
+            # иначе следующие стадии конвейера не смогли бы изменять VFS
+            tree_lines = self.vfs.iter_tree(path, depth=depth)
+            return self._guarded("tree", self._tree_page(path, tree_lines, limit, offset))
         except Exception as e:
-            self.print_output(f"Ошибка tree: {str(e)}")
+            self.print_error(f"Ошибка tree: {str(e)}")
     
-    def cmd_tac(self, args):
-        if not args:
-            self.print_output("tac: требуется указать файл")
+    @command("find")
+    def cmd_find(self, args):
+        paging = self._parse_paging("find", args)
+        if paging is None:
             return
+        limit, offset, args = paging
+        usage = "Использование: find [путь] [-name шаблон] [-type f|d] [-mindepth N] [-maxdepth N]"
+        path = "."
+        options = {"-name": None, "-type": None, "-mindepth": "0", "-maxdepth": "-1"}
+        if args and not args[0].startswith("-"):
+            path = args[0]
+            args = args[1:]
+        while args:
+            if args[0] not in options or len(args) < 2:
+                self.print_error(usage)
+                return
+            options[args[0]] = args[1]
+            args = args[2:]
         
-        file_path = args[0]
+        kind = options["-type"]
+        if kind not in (None, "f", "d"):
+            self.print_error(f"find: неизвестный тип '{kind}'")
+            return
         try:
-            content = self.vfs.get_file_content(file_path)
-            if content is None:
-                self.print_output(f"tac: {file_path}: Нет такого файла")
+            min_depth = int(options["-mindepth"])
+            max_depth = int(options["-maxdepth"])
+        except ValueError:
+            self.print_error("find: глубина должна быть числом")
+            return
+        
+        paths = self.vfs.find(path, options["-name"], kind, min_depth, max_depth)
+        if paths is None:
+            self.print_error(f"find: '{path}' не существует")
+            return
+        return self._page(paths, limit, offset)
+
+    @command("grep")
+    def cmd_grep(self, args):
+        paging = self._parse_paging("grep", args)
+        if paging is None:
+            return
+        limit, offset, args = paging
+        flags = set()
+        while args and args[0].startswith("-") and len(args[0]) > 1:
+            if set(args[0][1:]) - set("inl"):
+                self.print_error(f"grep: неизвестный параметр '{args[0]}'")
                 return
-            
-            lines = content.split('\n')
-            reversed_lines = reversed(lines)
-            
-            for line in reversed_lines:
-                self.print_output(line)
-        except Exception as e:
-            self.print_output(f"Ошибка tac: {str(e)}")
-    def cmd_script(self, args):
+            flags.update(args[0][1:])
+            args = args[1:]
         if not args:
-            self.print_output("Использование: script <путь_к_скрипту>")
+            self.print_error("Использование: grep [-i] [-n] [-l] <регулярное_выражение> [путь]")
             return
-    
-        script_path = args[0]
-        if not os.path.exists(script_path):
-            self.print_output(f"Ошибка: скрипт '{script_path}' не найден")
+        
+        stdin = self._stdin
+        if len(args) == 1 and stdin is not None:
+            # Без пути grep фильтрует строки предыдущей команды конвейера
+            try:
+                regex = re.compile(args[0], re.IGNORECASE if "i" in flags else 0)
+            except re.error as e:
+                self.print_error(f"grep: неверное регулярное выражение: {e}")
+                return
+            matches = ((line_num, line) for line_num, line in enumerate(stdin, 1) if regex.search(line))
+            if "l" in flags:
+                lines = ("(стандартный ввод)" for match in itertools.islice(matches, 1))
+            elif "n" in flags:
+                lines = (f"{line_num}:{line}" for line_num, line in matches)
+            else:
+                lines = (line for line_num, line in matches)
+            return self._page(lines, limit, offset)
+        
+        path = args[1] if len(args) > 1 else "."
+        try:
+            matches = self.vfs.grep(args[0], path, ignore_case="i" in flags)
+        except re.error as e:
+            self.print_error(f"grep: неверное регулярное выражение: {e}")
             return
-    
-        self.script_path = script_path
-        self.startup_script()
+        if matches is None:
+            self.print_error(f"grep: '{path}' не существует")
+            return
+        
+        if "l" in flags:
+            lines = (file_path for file_path, group in itertools.groupby(matches, key=lambda match: match[0]))
+        elif "n" in flags:
+            lines = (f"{file_path}:{line_num}:{line}" for file_path, line_num, line in matches)
+        else:
+            lines = (f"{file_path}:{line}" for file_path, line_num, line in matches)
+        return self._page(lines, limit, offset)
 
-    def cmd_ls(self, args):
-        path = args[0] if args else "."
+    @command("index")
+    def cmd_index(self, args):
+        index = self.vfs.index
+        if args and args[0] == "trigrams":
+            self.print_output(f"Триграммный индекс построен (файлов с различным содержимым: "
+                              f"{self.vfs.build_trigram_index()})")
+            return
+        if args:
+            self.print_error("Использование: index [trigrams]")
+            return
+        self.print_output(f"Индекс имен: {len(index.names)} различных имен")
+        if index.trigrams is None:
+            self.print_output("Триграммный индекс выключен (index trigrams или --trigram-index)")
+        else:
+            self.print_output(f"Триграммный индекс: {len(index.trigrams)} триграмм, "
+                              f"{len(index.blob_trigrams)} проиндексировано, "
+                              f"{len(index.unindexed)} без индекса (двоичные или большие)")
+
+    @command("du")
+    def cmd_du(self, args):
+        max_depth = -1
+        path = "."
+        while args:
+            if args[0] == "-s":
+                max_depth = 0
+                args = args[1:]
+            elif args[0] == "-d":
+                if len(args) < 2 or not args[1].isdigit():
+                    self.print_error("du: -d требует неотрицательное число")
+                    return
+                max_depth = int(args[1])
+                args = args[2:]
+            elif args[0].startswith("-") or len(args) > 1:
+                self.print_error("Использование: du [-s] [-d N] [путь]")
+                return
+            else:
+                path = args[0]
+                args = args[1:]
+        
+        entries = self.vfs.iter_du(path, max_depth)
+        if entries is None:
+            self.print_error(f"du: '{path}' не существует")
+            return
+        return self._guarded("du", (f"{size}\t{files}\t{entry_path}" for entry_path, size, files in entries))
+
+    @command("df")
+    def cmd_df(self, args):
+        usage = self.vfs.usage()
+        return iter((
+            f"Файлов: {usage.files}, объем: {usage.size} байт",
+            f"Различное содержимое: {usage.unique} байт в {usage.blobs} blob (копии файлов не занимают места)",
+            f"  в памяти: {usage.resident} байт, читается из архивов по требованию: {usage.unique - usage.resident} байт",
+            f"Кэш распакованных файлов: {usage.cache_used} из {usage.cache_limit} байт",
+            f"Слоев overlay: {usage.layers}" if usage.layers else "Слои overlay не подключены",
+        ))
+
+    @command("tac")
+    def cmd_tac(self, args):
+        if not args:
+            if self._stdin is not None:
+                return self._reversed_lines(self._stdin)
+            self.print_error("tac: требуется указать файл")
+            return
         
+        file_path = args[0]
         try:
-            items = self.vfs.list_dir(path)
-            if not items:
-                self.print_output("Директория пуста")
+            reversed_lines = self.vfs.iter_lines_reversed(file_path)
+            if reversed_lines is None:
+                self.print_error(f"tac: {file_path}: Нет такого файла")
                 return
             
-            for item in items:
-                self.print_output(item)
+            return self._guarded("tac", reversed_lines)
         except Exception as e:
-            self.print_output(f"Ошибка ls: {str(e)}")
-    
-    def cmd_cd(self, args):
+            self.print_error(f"Ошибка tac: {str(e)}")
+
+    @staticmethod
+    def _reversed_lines(lines):
+        yield from reversed(list(lines))
+
+    @staticmethod
+    def _file_lines(lines):
+        # Последний элемент пустой, если файл заканчивается переводом строки
+        pending = None
+        for line in lines:
+            if pending is not None:
+                yield pending
+            pending = line
+        if pending:
+            yield pending
+
+    def _parse_line_count(self, name, args):
+        # Без файла строки читаются из конвейера (file_path равен None)
+        count = 10
+        if args and args[0] == "-n":
+            if len(args) < 2 or not args[1].isdigit():
+                self.print_error(f"{name}: неверное количество строк")
+                return None, None
+            count = int(args[1])
+            args = args[2:]
+        if not args and self._stdin is None:
+            self.print_error(f"{name}: требуется указать файл")
+            return None, None
+        return count, args[0] if args else None
+
+    @command("cat")
+    def cmd_cat(self, args):
         if not args:
-            target = "/"
-        else:
-            target = args[0]
-        
-        try:
-            success = self.vfs.change_dir(target)
-            if not success:
-                self.print_output(f"cd: {target}: Нет такой директории")
-            else:
-                self.update_environment()
-        except Exception as e:
-            self.print_output(f"Ошибка cd: {str(e)}")
-    
-    def cmd_pwd(self):
-        self.print_output(self.vfs.get_curr_path())
-    
-    def cmd_tree(self, args):
-        path = args[0] if args else "."
-        depth = -1
-        
-        if len(args) >= 2 and args[0] == "-L":
+            if self._stdin is not None:
+                return self._stdin
+            self.print_error("cat: требуется указать файл")
+            return
+        return self._cat_lines(args)
+
+    def _cat_lines(self, paths):
+        for file_path in paths:
             try:
-                depth = int(args[1])
-                path = args[2] if len(args) > 2 else "."
-            except ValueError:
-                self.print_output("tree: неверный аргумент глубины")
-                return
+                lines = self.vfs.iter_lines(file_path)
+                if lines is None:
+                    self.print_error(f"cat: {file_path}: Нет такого файла")
+                    continue
+                yield from self._file_lines(lines)
+            except Exception as e:
+                self.print_error(f"Ошибка cat: {str(e)}")
+
+    @command("head")
+    def cmd_head(self, args):
+        count, file_path = self._parse_line_count("head", args)
+        if count is None:
+            return
+        if file_path is None:
+            return itertools.islice(self._stdin, count)
         
         try:
-            tree_lines = self.vfs.tree_traverse(path, depth=depth)
-            if not tree_lines:
-                self.print_output(f"{path} [пустая директория]")
+            lines = self.vfs.iter_lines(file_path)
+            if lines is None:
+                self.print_error(f"head: {file_path}: Нет такого файла")
                 return
-            
-            self.print_output(path)
-            for line in tree_lines:
-                self.print_output(line)
+            return self._guarded("head", itertools.islice(self._file_lines(lines), count))
         except Exception as e:
-            self.print_output(f"Ошибка tree: {str(e)}")
-    
-    def cmd_tac(self, args):
-        if not args:
-            self.print_output("tac: требуется указать файл")
+            self.print_error(f"Ошибка head: {str(e)}")
+
+    @command("tail")
+    def cmd_tail(self, args):
+        count, file_path = self._parse_line_count("tail", args)
+        if count is None:
             return
+        if file_path is None:
+            return self._last_lines(self._stdin, count)
         
-        file_path = args[0]
         try:
-            content = self.vfs.get_file_content(file_path)
-            if content is None:
-                self.print_output(f"tac: {file_path}: Нет такого файла")
+            reversed_lines = self.vfs.iter_lines_reversed(file_path)
+            if reversed_lines is None:
+                self.print_error(f"tail: {file_path}: Нет такого файла")
                 return
-            
-            lines = content.split('\n')
-            reversed_lines = reversed(lines)
-            
-            for line in reversed_lines:
-                self.print_output(line)
+            return self._guarded("tail", self._tail_reversed(reversed_lines, count))
         except Exception as e:
-            self.print_output(f"Ошибка tac: {str(e)}")
+            self.print_error(f"Ошибка tail: {str(e)}")
+
+    @staticmethod
+    def _last_lines(lines, count):
+        yield from deque(lines, maxlen=count)
+
+    @staticmethod
+    def _tail_reversed(reversed_lines, count):
+        last = next(reversed_lines, "")
+        if last:
+            reversed_lines = itertools.chain([last], reversed_lines)
+        yield from reversed(list(itertools.islice(reversed_lines, count)))
+
+    @command("script")
     def cmd_script(self, args):
         if not args:
-            self.print_output("Использование: script <путь_к_скрипту>")
+            self.print_error("Использование: script <путь_к_скрипту>")
             return
     
         script_path = args[0]
         if not os.path.exists(script_path):
-            self.print_output(f"Ошибка: скрипт '{script_path}' не найден")
+            self.print_error(f"Ошибка: скрипт '{script_path}' не найден")
             return
     
-        self.script_path = script_path
-        self.startup_script()
+        self.start_script(script_path)
+
+    @command("batch")
+    def cmd_batch(self, args):
+        jobs = None
+        if len(args) >= 2 and args[0] in ("-j", "--jobs"):
+            if not args[1].isdigit() or int(args[1]) < 1:
+                self.print_error(f"batch: неверное число процессов '{args[1]}'")
+                return
+            jobs = int(args[1])
+            args = args[2:]
+        if not args:
+            self.print_error("Использование: batch [-j N] <скрипт> [<скрипт> ...]")
+            return
+        
+        start = time.perf_counter()
+        try:
+            results = run_batch(self.vfs, args, jobs)
+        except Exception as e:
+            self.print_error(f"Ошибка batch: {str(e)}")
+            return
+        for line in format_batch_report(results, time.perf_counter() - start):
+            self.print_output(line)
 
+    @command("vfs")
     def cmd_vfs(self, args):
+        lazy = None
+        if args and args[0] in ("-l", "--lazy"):
+            lazy = True
+            args = args[1:]
         if not args:
-            self.print_output("Использование: vfs")
+            self.print_error("Использование: vfs [--lazy] <путь_к_архиву>")
             return
     
         vfs_path = args[0]
         if not os.path.exists(vfs_path):
-            self.print_output(f"Ошибка: арxив '{vfs_path}' не найден совсем")
+            self.print_error(f"Ошибка: арxив '{vfs_path}' не найден совсем")
             return
     
         try:
-            self.vfs.load_from_zip(vfs_path)
+            self.vfs.load(vfs_path, lazy=lazy)
             self.vfs_path = vfs_path
             self.update_environment()
             self.print_output(f"VFS успешно загружена из '{vfs_path}'")
             self.print_output(f"Текущая директория: {self.vfs.get_curr_path()}")
         except Exception as e:
-            self.print_output(f"Ошибка загрузки VFS: {str(e)}")
+            self.print_error(f"Ошибка загрузки VFS: {str(e)}")
     
 
+    @command("mount")
+    def cmd_mount(self, args):
+        if not args:
+            if not self.vfs.lowers:
+                self.print_output("VFS не смонтирована поверх слоев. Использование: mount <архив> [<архив> ...]")
+                return
+            self.print_output("Слои (нижний первым), верхний слой в памяти:")
+            for lower in self.vfs.lowers:
+                self.print_output(f"  {lower.base_path or '[VFS в памяти]'}")
+            return
+        
+        for layer_path in args:
+            if not os.path.exists(layer_path):
+                self.print_error(f"Ошибка: архив '{layer_path}' не найден")
+                return
+        try:
+            self.vfs.mount(args)
+            self.update_environment()
+            self.print_output(f"VFS смонтирована поверх слоев: {len(args)}, изменения идут в верхний слой")
+        except Exception as e:
+            self.print_error(f"Ошибка mount: {str(e)}")
+
     def command_reader(self, command):
-        parsed = self.parse_env_var(command)
-        cmd_parts = parsed.split()
+        cmd_parts = self.parse_env_var(command).split()
         if not cmd_parts:
             return
+        if PIPELINE_TOKENS.isdisjoint(cmd_parts):
+            self.execute(cmd_parts[0], cmd_parts[1:])
+        else:
+            self.run_pipeline(cmd_parts)
+
+    def run_pipeline(self, cmd_parts):
+        # Стадии связаны генераторами строк: команда читает вывод предыдущей по мере надобности.
+        # Перенаправленный вывод не выводится на экран, а целиком записывается в файл VFS
+        redirect = None
+        if len(cmd_parts) >= 2 and cmd_parts[-2] in (">", ">>"):
+            redirect = cmd_parts[-2]
+            target = cmd_parts[-1]
+            cmd_parts = cmd_parts[:-2]
+        stages = [[]]
+        for part in cmd_parts:
+            if part == "|":
+                stages.append([])
+            else:
+                stages[-1].append(part)
+        if (not all(stages) or not PIPELINE_TOKENS.isdisjoint(itertools.chain.from_iterable(stages))
+                or redirect is not None and target in PIPELINE_TOKENS):
+            self.print_error("Ошибка: неверный конвейер (использование: команда [| команда ...] [> | >> файл])")
+            return
         
-        cmd = cmd_parts[0]
-        args = cmd_parts[1:]
+        outputs = []
+        lines = None
+        try:
+            for stage in stages:
+                lines = self.execute(stage[0], stage[1:], stdin=lines, capture=True)
+                outputs.append(lines)
+            if redirect is None:
+                for line in lines:
+                    self.print_output(line)
+                return
+            content = "".join(line + "\n" for line in lines)
+        finally:
+            # Недочитанные стадии закрываются, чтобы отпустить блокировки чтения до записи
+            for output in outputs:
+                output.close()
         
-        if cmd == "exit":
+        success, message = self.vfs.write_file(target, content, append=redirect == ">>")
+        if not success:
+            self.print_error(f"Ошибка перенаправления: {message}")
+
+    @staticmethod
+    def _stage_output(captured, lines):
+        yield from captured
+        if lines is not None:
+            yield from lines
+
+    def execute(self, cmd, args, stdin=None, capture=False):
+        # Команда может вернуть итератор строк. С capture=True вывод не печатается,
+        # а возвращается генератором строк для следующей стадии конвейера
+        handler = self.commands.get(cmd)
+        if handler is None:
+            self.print_error(f"Ошибка: неизвестная команда '{cmd}'")
+            return self._stage_output((), None) if capture else None
+        start = time.perf_counter()
+        stdin, self._stdin = self._stdin, stdin
+        if capture:
+            self._captures.append([])
+        try:
+            lines = handler(args)
+            if capture:
+                return self._stage_output(self._captures[-1], lines)
+            if lines is not None:
+                try:
+                    for line in lines:
+                        self.print_output(line)
+                finally:
+                    close = getattr(lines, "close", None)
+                    if close is not None:
+                        close()
+        finally:
+            if capture:
+                self._captures.pop()
+            self._stdin = stdin
+            self.stats.record("cmd." + cmd, time.perf_counter() - start)
+
+
+class TerminalEmulator(Shell):
+    DEFAULT_SCROLLBACK = 10000
+    SCRIPT_POLL_MS = 30
+    JOURNAL_SYNC_MS = 1000
+
+    def __init__(self, root, script_path=None, vfs_path=None, lazy=False,
+                 cache_bytes=VFS.DEFAULT_CACHE_BYTES, scrollback=DEFAULT_SCROLLBACK, profile_path=None,
+                 journal_path=None, trigrams=False, layers=None):
+        self.root = root
+        self.root.title("VFS Terminal Emulator")
+        self.scrollback = scrollback
+        self.output_area = None
+        self._output_buffer = []
+        self._flush_scheduled = False
+        self._main_thread = threading.current_thread()
+        self._script_events = queue.Queue()
+        self._script_active = False
+
+        super().__init__(vfs_path, lazy=lazy, cache_bytes=cache_bytes, profile_path=profile_path,
+                         journal_path=journal_path, trigrams=trigrams, layers=layers)
+        if self.vfs is None:
             self.root.quit()
-        elif cmd == "ls":
-            self.cmd_ls(args)
-        elif cmd == "cd":
-            self.cmd_cd(args)
-        elif cmd == "pwd":
-            self.cmd_pwd()
-        elif cmd == "echo":
-            self.print_output(" ".join(args).rstrip('"').lstrip('"'))
-        elif cmd == "cls":
-            self.output_area.config(state=tk.NORMAL)
-            self.output_area.delete(1.0, tk.END)
-            self.output_area.config(state=tk.DISABLED)
-        elif cmd == "tree":
-            self.cmd_tree(args)
-        elif cmd == "tac":
-            self.cmd_tac(args)
-        elif cmd == "touch":
-            self.cmd_touch(args)
-        elif cmd == "cp":
-            self.cmd_cp(args)
-        elif cmd == "savevfs":
-            self.cmd_savevfs(args)
-        elif cmd == "script":
-            self.cmd_script(args)
-        elif cmd == "vfs":
-            self.cmd_vfs(args)
-        else:
-            self.print_output(f"Ошибка: неизвестная команда '{cmd}'")
+            return 
+        
+        self.script_path = script_path
+        main_frame = tk.Frame(self.root)
+        main_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        self.output_area = scrolledtext.ScrolledText(main_frame, height=20)
+        self.output_area.pack(fill=tk.BOTH, expand=True)
+        self.output_area.config(state=tk.DISABLED)
+        
+        input_frame = tk.Frame(main_frame)
+        input_frame.pack(fill=tk.X, pady=(5, 0))
+        
+        self.prompt_label = tk.Label(input_frame, text=self.prompt_text)
+        self.prompt_label.pack(side=tk.LEFT)
+        
+        self.input_field = tk.Entry(input_frame, relief=tk.FLAT)
+        self.input_field.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(5, 0))
+        self.input_field.focus()
+        
+        self.input_field.bind('<Return>', self.process_command)
+        self.input_field.bind('<Tab>', self.complete_input)
+
+        self.status_var = tk.StringVar()
+        self.status_label = tk.Label(main_frame, textvariable=self.status_var, anchor=tk.W)
+        self.status_label.pack(fill=tk.X)
+       
+        self.print_output("")
+        if self.vfs.journal is not None:
+            self.root.after(self.JOURNAL_SYNC_MS, self._sync_journal)
+        
+        if script_path:
+            self.startup_script()
+
+    def _sync_journal(self):
+        # Последние записи журнала не должны ждать следующей команды дольше секунды
+        self.vfs.sync_journal()
+        self.root.after(self.JOURNAL_SYNC_MS, self._sync_journal)
+    
+    def _on_main_thread(self):
+        return threading.current_thread() is self._main_thread
+
+    def print_output(self, text):
+        if self._captures:
+            self._captures[-1].append(text)
+            return
+        # Вывод фонового скрипта передается в GUI через очередь событий
+        if not self._on_main_thread():
+            self._script_events.put(("output", text))
+            return
+        # Строки копятся в буфере и выводятся одной вставкой за такт цикла событий
+        self._output_buffer.append(text)
+        if len(self._output_buffer) > 2 * self.scrollback:
+            del self._output_buffer[:-self.scrollback]
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.root.after(0, self._flush_output)
+
+    def _flush_output(self):
+        self._flush_scheduled = False
+        if self.output_area is None or not self._output_buffer:
+            return
+        start = time.perf_counter()
+        lines = self._output_buffer[-self.scrollback:]
+        self._output_buffer = []
+
+        self.output_area.config(state=tk.NORMAL)
+        self.output_area.insert(tk.END, "\n".join(lines) + "\n")
+        line_count = int(self.output_area.index("end-1c").split(".")[0]) - 1
+        if line_count > self.scrollback:
+            self.output_area.delete("1.0", f"{line_count - self.scrollback + 1}.0")
+        self.output_area.config(state=tk.DISABLED)
+        self.output_area.see(tk.END)
+        self.stats.record("gui.flush", time.perf_counter() - start)
+
+    def clear_output(self):
+        if not self._on_main_thread():
+            self._script_events.put(("clear",))
+            return
+        self._output_buffer = []
+        self.output_area.config(state=tk.NORMAL)
+        self.output_area.delete(1.0, tk.END)
+        self.output_area.config(state=tk.DISABLED)
     
+    def request_exit(self):
+        if not self._on_main_thread():
+            self._script_cancel.set()
+            self._script_events.put(("exit",))
+            return
+        self.root.quit()
+
+    def report_progress(self, script_path, line_num, total):
+        self._script_events.put(("progress", script_path, line_num, total))
+
+    def start_script(self, script_path):
+        if self._on_main_thread():
+            self.script_path = script_path
+            self.startup_script()
+        else:
+            self.run_script(script_path)
+
+    def script_running(self):
+        return self._script_active
+
+    def startup_script(self):
+        if self._script_active:
+            self.print_output("Ошибка: скрипт уже выполняется")
+            return
+        
+        self._script_active = True
+        self._script_cancel.clear()
+        # Ctrl+C прерывает скрипт только пока он выполняется, в остальное время это копирование
+        self.root.bind('<Control-c>', lambda event: self.cancel_script())
+        worker = threading.Thread(target=self._script_worker, args=(self.script_path,), daemon=True)
+        worker.start()
+        self.root.after(self.SCRIPT_POLL_MS, self._poll_script)
+
+    def _script_worker(self, script_path):
+        try:
+            self.run_script(script_path)
+        finally:
+            self._script_events.put(("done",))
+
+    def _poll_script(self):
+        done = False
+        try:
+            while True:
+                event = self._script_events.get_nowait()
+                kind = event[0]
+                if kind == "output":
+                    self.print_output(event[1])
+                elif kind == "progress":
+                    self.status_var.set(f"Скрипт '{event[1]}': строка {event[2]} из {event[3]}")
+                elif kind == "clear":
+                    self.clear_output()
+                elif kind == "exit":
+                    self.root.quit()
+                elif kind == "done":
+                    done = True
+        except queue.Empty:
+            pass
+
+        if done:
+            self._script_active = False
+            self.root.unbind('<Control-c>')
+            self.status_var.set("")
+        else:
+            self.root.after(self.SCRIPT_POLL_MS, self._poll_script)
+
+    def cancel_script(self):
+        if not self._script_active:
+            self.print_output("Нет выполняемого скрипта")
+            return
+        self._script_cancel.set()
+
+    def complete_input(self, event):
+        # Tab дополняет слово перед курсором; если дополнять нечего, выводятся варианты
+        cursor = self.input_field.index(tk.INSERT)
+        line = self.input_field.get()[:cursor]
+        completed, candidates = self.complete(line)
+        if completed != line:
+            self.input_field.delete(0, cursor)
+            self.input_field.insert(0, completed)
+            self.input_field.icursor(len(completed))
+        elif len(candidates) > 1:
+            self.print_output(f"{self.prompt_text}> {line}")
+            self.print_output("  ".join(os.path.basename(candidate.rstrip("/")) +
+                                        ("/" if candidate.endswith("/") else "") for candidate in candidates))
+        return "break"
+
     def process_command(self, event):
         command = self.input_field.get().strip()
         self.input_field.delete(0, tk.END)
@@ -653,18 +3383,355 @@ class TerminalEmulator:
             return
         
         self.print_output(f"{self.prompt_text}> {command}")
+        if self.script_running() and command != "cancel":
+            self.print_output("Выполняется скрипт: дождитесь завершения или введите 'cancel'")
+            return
         try:
             self.command_reader(command)
         except Exception as e:
-            self.print_output(f"Ошибка: {str(e)}")
-    
-        
-    
-    
+            self.print_error(f"Ошибка: {str(e)}")
+
+
+class ShellSession(Shell):
+    # Сессия сервера: общая VFS через собственный VFSHandle (своя рабочая директория),
+    # свои окружение и буфер вывода. Команды, читающие и пишущие файлы хоста,
+    # доступны только с host_commands=True
+    HOST_COMMANDS = ("savevfs", "script", "vfs", "mount", "batch", "journal")
+
+    def __init__(self, vfs, env=None, host_commands=False):
+        # Окружение сервера в сессию не копируется: в ней только USER, HOME, PWD и DATE
+        super().__init__(output=io.StringIO(), vfs=vfs.handle(), env={} if env is None else env)
+        if not host_commands:
+            for name in self.HOST_COMMANDS:
+                self.commands[name] = functools.partial(self._host_command_denied, name)
+
+    def _host_command_denied(self, name, args):
+        self.print_error(f"Ошибка: команда '{name}' обращается к файлам сервера и отключена "
+                         f"(запустите сервер с --server-host-commands)")
+
+    def run_command(self, line):
+        try:
+            self.command_reader(line)
+        except Exception as e:
+            self.print_error(f"Ошибка: {str(e)}")
+        text = self.output.getvalue()
+        self.output.seek(0)
+        self.output.truncate()
+        return text
+
+
+class ShellServer:
+    # Клиент посылает команду строкой, сервер отвечает ее выводом с длиной в заголовке
+    # RESPONSE_HEADER: вывод cat двоичного файла может содержать любые байты.
+    # Команды выполняются в пуле потоков, и долгие tree или grep не задерживают остальные
+    # сессии; с workers=0 - прямо в цикле событий
+    RESPONSE_HEADER = struct.Struct("!I")
+    DEFAULT_WORKERS = 4
+    JOURNAL_SYNC_INTERVAL = 1.0
+
+    def __init__(self, vfs, workers=DEFAULT_WORKERS, overlay=False, host_commands=False):
+        self.vfs = vfs
+        self.overlay = overlay
+        self.host_commands = host_commands
+        self.sessions = 0
+        self.server = None
+        self.pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+
+    async def start(self, host=None, port=None, unix_path=None):
+        if unix_path:
+            self.server = await asyncio.start_unix_server(self.handle, path=unix_path)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def serve_forever(self):
+        sync_task = asyncio.ensure_future(self._sync_journal())
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            sync_task.cancel()
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+
+    async def _sync_journal(self):
+        while True:
+            await asyncio.sleep(self.JOURNAL_SYNC_INTERVAL)
+            self.vfs.sync_journal()
+
+    async def handle(self, reader, writer):
+        # С overlay каждая сессия пишет в свой верхний слой над общей неизменной VFS
+        session = ShellSession(self.vfs.overlay() if self.overlay else self.vfs,
+                               host_commands=self.host_commands)
+        self.sessions += 1
+        loop = asyncio.get_running_loop()
+        try:
+            while not session.exited:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace').strip()
+                if self.pool is None:
+                    text = session.run_command(line)
+                else:
+                    text = await loop.run_in_executor(self.pool, session.run_command, line)
+                data = text.encode('utf-8', 'replace')
+                writer.write(self.RESPONSE_HEADER.pack(len(data)) + data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+BatchResult = namedtuple("BatchResult", "script status commands errors load_s run_s output")
+
+
+class BatchShell(Shell):
+    # Оболочка пакетного прогона: вывод копится в памяти, код завершения скрипта
+    # определяется по числу ошибок, выведенных через print_error
+    def __init__(self, vfs):
+        super().__init__(output=io.StringIO(), vfs=vfs)
+
+
+_batch_snapshot = None
+
+
+def _init_batch_worker(snapshot_path):
+    global _batch_snapshot
+    _batch_snapshot = snapshot_path
+
+
+def _run_batch_script(script_path):
+    # Каждый скрипт получает свою VFS из общего снимка: файл отображается в память,
+    # страницы данных делятся между процессами, изменения остаются в процессе
+    start = time.perf_counter()
+    if not os.path.exists(script_path):
+        return BatchResult(script_path, 2, 0, 1, 0.0, 0.0, f"Ошибка: скрипт '{script_path}' не найден\n")
+    try:
+        with redirect_stdout(io.StringIO()):
+            vfs = VFS(_batch_snapshot)
+        loaded = time.perf_counter()
+        shell = BatchShell(vfs)
+        shell.run_script(script_path)
+        commands = len(compile_script(script_path).commands)
+    except Exception as e:
+        return BatchResult(script_path, 2, 0, 1, time.perf_counter() - start, 0.0,
+                           f"Ошибка выполнения скрипта: {str(e)}\n")
+    return BatchResult(script_path, 1 if shell.failures else 0, commands, shell.failures,
+                       loaded - start, time.perf_counter() - loaded, shell.output.getvalue())
+
+
+def run_batch(vfs, script_paths, jobs=None):
+    # Образ сохраняется в снимок один раз, скрипты выполняются в пуле процессов
+    # независимо друг от друга; результаты возвращаются в порядке script_paths
+    jobs = jobs or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_path = os.path.join(tmp_dir, "batch" + SNAPSHOT_EXT)
+        success, message = vfs.save_snapshot(snapshot_path)
+        if not success:
+            raise RuntimeError(message)
+        with ProcessPoolExecutor(max_workers=min(jobs, len(script_paths)),
+                                 initializer=_init_batch_worker, initargs=(snapshot_path,)) as pool:
+            return list(pool.map(_run_batch_script, script_paths))
+
+
+def format_batch_report(results, wall_s):
+    lines = [f"{'код':>3} {'команд':>7} {'ошибок':>7} {'загрузка, с':>12} {'выполнение, с':>14}  скрипт"]
+    for result in results:
+        lines.append(f"{result.status:3} {result.commands:7} {result.errors:7} "
+                     f"{result.load_s:12.3f} {result.run_s:14.3f}  {result.script}")
+    failed = sum(1 for result in results if result.status)
+    total = sum(result.load_s + result.run_s for result in results)
+    lines.append(f"Скриптов: {len(results)}, успешно: {len(results) - failed}, с ошибками: {failed}; "
+                 f"время {wall_s:.3f} с (сумма по скриптам {total:.3f} с)")
+    return lines
+
+
+def current_user():
+    try:
+        return os.getlogin()
+    except OSError:
+        return getpass.getuser()
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="VFS Terminal Emulator")
+    parser.add_argument("--vfs", default="", help="ZIP-архив с образом VFS")
+    parser.add_argument("--script", action="append", default=[],
+                        help="скрипт для выполнения (можно указать несколько раз)")
+    parser.add_argument("--headless", action="store_true",
+                        help="выполнять команды без GUI, вывод в stdout или --output")
+    parser.add_argument("--batch", action="store_true",
+                        help="выполнить скрипты --script параллельно, каждый на своей копии образа")
+    parser.add_argument("--jobs", type=int, help="число процессов для --batch (по умолчанию - число ядер)")
+    parser.add_argument("--report", help="записать отчет --batch с выводом скриптов в JSON-файл")
+    parser.add_argument("--output", help="файл для вывода в режиме --headless")
+    parser.add_argument("--lazy", action="store_true",
+                        help="распаковывать файлы архива по требованию")
+    parser.add_argument("--layer", action="append", default=[],
+                        help="нижний слой overlay только для чтения (можно указать несколько раз, нижний первым)")
+    parser.add_argument("--trigram-index", action="store_true",
+                        help="построить триграммный индекс содержимого для grep")
+    parser.add_argument("--cache-bytes", type=int, default=VFS.DEFAULT_CACHE_BYTES,
+                        help="объем кэша распакованных файлов в ленивом режиме")
+    parser.add_argument("--profile", help="записать профиль cProfile выполнения скриптов в файл")
+    parser.add_argument("--journal", help="журнал изменений VFS: применяется при запуске, дополняется командами")
+    parser.add_argument("--compact", action="store_true",
+                        help="после применения журнала свернуть его в базовый образ --vfs")
+    parser.add_argument("--serve", metavar="HOST:PORT",
+                        help="запустить сервер сессий на TCP-адресе вместо GUI")
+    parser.add_argument("--unix", metavar="PATH", help="запустить сервер сессий на Unix-сокете")
+    parser.add_argument("--server-workers", type=int, default=ShellServer.DEFAULT_WORKERS,
+                        help="потоков для команд сервера (0 - выполнять в цикле событий)")
+    parser.add_argument("--server-host-commands", action="store_true",
+                        help="разрешить сессиям команды с файлами сервера (savevfs, script, vfs, mount, batch, journal)")
+    parser.add_argument("--session-overlay", action="store_true",
+                        help="у каждой сессии сервера свой верхний слой поверх общей VFS")
+    return parser
+
+
+def run_headless(args):
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    shell = None
+    try:
+        shell = Shell(args.vfs, lazy=args.lazy, cache_bytes=args.cache_bytes, output=output,
+                      profile_path=args.profile, journal_path=args.journal, trigrams=args.trigram_index,
+                      layers=args.layer)
+        if shell.vfs is None:
+            return 1
+        if args.compact:
+            shell.cmd_journal(["compact"])
+
+        if args.script:
+            for script_path in args.script:
+                if shell.exited:
+                    break
+                if not os.path.exists(script_path):
+                    shell.print_error(f"Ошибка: скрипт '{script_path}' не найден")
+                    return 1
+                shell.run_script(script_path)
+        else:
+            for line in sys.stdin:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    shell.command_reader(line)
+                except Exception as e:
+                    shell.print_error(f"Ошибка: {str(e)}")
+                if shell.exited:
+                    break
+        return 0
+    finally:
+        if shell is not None:
+            shell.close()
+        if output is not sys.stdout:
+            output.close()
+
+
+def run_batch_cli(args):
+    if not args.script:
+        print("Ошибка: для --batch укажите скрипты через --script", file=sys.stderr)
+        return 1
+    try:
+        vfs = VFS(args.vfs, lazy=args.lazy, cache_bytes=args.cache_bytes, journal_path=args.journal,
+                  layers=args.layer)
+    except Exception as e:
+        print(f"Ошибка VFS: {str(e)}", file=sys.stderr)
+        return 1
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        start = time.perf_counter()
+        results = run_batch(vfs, args.script, args.jobs)
+        wall_s = time.perf_counter() - start
+        for line in format_batch_report(results, wall_s):
+            output.write(line + "\n")
+        if args.report:
+            with open(args.report, "w", encoding="utf-8") as f:
+                json.dump({"wall_s": wall_s, "jobs": args.jobs or os.cpu_count() or 1,
+                           "results": [result._asdict() for result in results]},
+                          f, indent=2, ensure_ascii=False)
+        return 1 if any(result.status for result in results) else 0
+    finally:
+        vfs.close()
+        if output is not sys.stdout:
+            output.close()
+
+
+def run_server(args):
+    try:
+        vfs = VFS(args.vfs, lazy=args.lazy, cache_bytes=args.cache_bytes, stats=Stats(),
+                  journal_path=args.journal, trigrams=args.trigram_index, layers=args.layer)
+    except Exception as e:
+        print(f"Ошибка VFS: {str(e)}", file=sys.stderr)
+        return 1
+    if args.compact:
+        print(vfs.compact_journal()[1])
+
+    host, port = None, None
+    if args.serve:
+        host, _, port = args.serve.rpartition(":")
+        host = host or "127.0.0.1"
+        port = int(port)
+    server = ShellServer(vfs, args.server_workers, args.session_overlay, args.server_host_commands)
+
+    async def serve():
+        listener = await server.start(host, port, args.unix)
+        addresses = ", ".join(str(sock.getsockname()) for sock in listener.sockets)
+        print(f"Сервер VFS слушает {addresses}", flush=True)
+        await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        vfs.close()
+    return 0
+
+
+def run_gui(args):
+    if tk is None:
+        print("Ошибка: tkinter недоступен, используйте --headless", file=sys.stderr)
+        return 1
+    if len(args.script) > 1:
+        print("Ошибка: в режиме GUI поддерживается только один --script", file=sys.stderr)
+        return 1
+
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"Ошибка запуска GUI: {e}. Используйте --headless", file=sys.stderr)
+        return 1
+    root.geometry("800x600") 
+
+    emulator = TerminalEmulator(root, args.script[0] if args.script else "", args.vfs,
+                                lazy=args.lazy, cache_bytes=args.cache_bytes, profile_path=args.profile,
+                                journal_path=args.journal, trigrams=args.trigram_index, layers=args.layer)
+    if args.compact and emulator.vfs is not None:
+        emulator.cmd_journal(["compact"])
+    root.mainloop()
+    emulator.close()
+    return 0
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.batch:
+        return run_batch_cli(args)
+    if args.serve or args.unix:
+        return run_server(args)
+    if args.headless:
+        return run_headless(args)
+    return run_gui(args)
 
-    
-root = tk.Tk()
-root.geometry("800x600") 
 
-terminal = TerminalEmulator(root, "", "")
-root.mainloop()                     
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+
+from Emulator import VFS
+
+
+def generate_archive(zip_path, breadth=10, depth=3, files=1000, binary_ratio=0.1,
+                     file_size=256, compression=zipfile.ZIP_DEFLATED, seed=0):
+    # Синтетический образ: дерево директорий breadth^depth, файлы раскладываются по кругу
+    rng = random.Random(seed)
+    dirs = [""]
+    level = [""]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(breadth):
+                next_level.append(f"{parent}d{i}/")
+        dirs.extend(next_level)
+        level = next_level
+
+    text_line = b"synthetic text line for vfs benchmark\n"
+    text_body = (text_line * (file_size // len(text_line) + 1))[:file_size]
+    file_paths = []
+    with zipfile.ZipFile(zip_path, 'w', compression) as zipf:
+        for dir_path in dirs[1:]:
+            zipf.writestr(dir_path, b"")
+        for i in range(files):
+            path = f"{dirs[i % len(dirs)]}f{i}"
+            if rng.random() < binary_ratio:
+                path += ".bin"
+                data = b"\xff\xfe" + rng.randbytes(max(file_size - 2, 0))
+            else:
+                path += ".txt"
+                data = text_body
+            zipf.writestr(path, data)
+            file_paths.append(path)
+    return dirs, file_paths
+
+
+def measure(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ops = func()
+        samples.append(time.perf_counter() - start)
+    ops = ops or 1
+    best = min(samples)
+    return {
+        "ops": ops,
+        "min_s": best,
+        "median_s": statistics.median(samples),
+        "per_op_us": best / ops * 1e6,
+    }
+
+
+def run_benchmarks(zip_path, dirs, file_paths, ops=1000, repeat=3, seed=0):
+    rng = random.Random(seed)
+    sample_dirs = [rng.choice(dirs) or "/" for _ in range(ops)]
+    sample_files = [rng.choice(file_paths) for _ in range(ops)]
+    results = {}
+    quiet = io.StringIO()
+
+    def load(lazy):
+        def run():
+            stdout, sys.stdout = sys.stdout, quiet
+            try:
+                VFS(zip_path, lazy=lazy)
+            finally:
+                sys.stdout = stdout
+            return len(file_paths) + len(dirs)
+        return run
+
+    results["load_from_zip"] = measure(load(False), repeat)
+    results["load_from_zip_lazy"] = measure(load(True), repeat)
+
+    stdout, sys.stdout = sys.stdout, quiet
+    try:
+        vfs = VFS(zip_path)
+    finally:
+        sys.stdout = stdout
+
+    def normalize_path():
+        vfs.curr_dir = "/"
+        for path in sample_files:
+            vfs.normalize_path(path)
+            vfs.normalize_path("../" + path)
+        return 2 * len(sample_files)
+
+    def list_dir():
+        for path in sample_dirs:
+            vfs.list_dir("/" + path)
+        return len(sample_dirs)
+
+    def change_dir():
+        for path in sample_dirs:
+            vfs.change_dir("/" + path)
+        vfs.change_dir("/")
+        return len(sample_dirs)
+
+    def tree_traverse():
+        return len(vfs.tree_traverse("/")) or 1
+
+    def create_file():
+        created = 0
+        for i, path in enumerate(sample_dirs):
+            success, _ = vfs.create_file(f"/{path}bench_new_{created}_{i}.txt", "x")
+            created += success
+        return created
+
+    def copy_file():
+        for i, path in enumerate(sample_files):
+            vfs.copy_file("/" + path, f"/{path}.copy{i}")
+        return len(sample_files)
+
+    def find_name():
+        for path in sample_files:
+            list(vfs.find("/", name=path.rsplit("/", 1)[-1]))
+        return len(sample_files)
+
+    def grep():
+        vfs.grep("synthetic", "/")
+        return len(file_paths)
+
+    results["normalize_path"] = measure(normalize_path, repeat)
+    results["list_dir"] = measure(list_dir, repeat)
+    results["change_dir"] = measure(change_dir, repeat)
+    results["tree_traverse"] = measure(tree_traverse, repeat)
+    results["find_name"] = measure(find_name, repeat)
+    results["grep"] = measure(grep, repeat)
+    results["create_file"] = measure(create_file, 1)
+    results["copy_file"] = measure(copy_file, 1)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_path = os.path.join(tmp_dir, "saved.zip")
+
+        def save():
+            success, message = vfs.save_to_zip(out_path)
+            if not success:
+                raise RuntimeError(message)
+            return len(file_paths) + len(dirs)
+
+        results["save_to_zip"] = measure(save, repeat)
+
+        snapshot_path = os.path.join(tmp_dir, "saved.vfsnap")
+        success, message = vfs.save_snapshot(snapshot_path)
+        if not success:
+            raise RuntimeError(message)
+
+        def load_snapshot():
+            stdout, sys.stdout = sys.stdout, quiet
+            try:
+                VFS(snapshot_path)
+            finally:
+                sys.stdout = stdout
+            return len(file_paths) + len(dirs)
+
+        results["load_snapshot"] = measure(load_snapshot, repeat)
+
+    return results
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    lines = []
+    for name, current in results.items():
+        old = baseline.get(name)
+        if old is None:
+            lines.append(f"{name:22} {current['per_op_us']:12.2f} us/op   (нет в базовом прогоне)")
+            continue
+        ratio = current["per_op_us"] / old["per_op_us"] if old["per_op_us"] else float("inf")
+        lines.append(f"{name:22} {old['per_op_us']:12.2f} -> {current['per_op_us']:12.2f} us/op  x{ratio:.2f}")
+    return lines
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Нагрузочные тесты VFS на синтетических образах")
+    parser.add_argument("--breadth", type=int, default=10, help="поддиректорий в каждой директории")
+    parser.add_argument("--depth", type=int, default=3, help="глубина дерева директорий")
+    parser.add_argument("--files", type=int, default=10000, help="количество файлов")
+    parser.add_argument("--binary-ratio", type=float, default=0.1, help="доля двоичных файлов")
+    parser.add_argument("--file-size", type=int, default=256, help="размер файла в байтах")
+    parser.add_argument("--stored", action="store_true", help="создавать архив без сжатия")
+    parser.add_argument("--ops", type=int, default=1000, help="операций в каждом замере")
+    parser.add_argument("--repeat", type=int, default=3, help="повторов каждого замера")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--archive", help="сохранить сгенерированный архив по этому пути")
+    parser.add_argument("--output", help="записать результаты в JSON-файл")
+    parser.add_argument("--compare", help="сравнить с результатами из JSON-файла")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    compression = zipfile.ZIP_STORED if args.stored else zipfile.ZIP_DEFLATED
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        zip_path = args.archive or os.path.join(tmp_dir, "synthetic.zip")
+        start = time.perf_counter()
+        dirs, file_paths = generate_archive(zip_path, args.breadth, args.depth, args.files,
+                                            args.binary_ratio, args.file_size, compression, args.seed)
+        print(f"Архив: {len(dirs)} директорий, {len(file_paths)} файлов, "
+              f"{os.path.getsize(zip_path)} байт ({time.perf_counter() - start:.2f} с)")
+        results = run_benchmarks(zip_path, dirs, file_paths, args.ops, args.repeat, args.seed)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {key: value for key, value in vars(args).items()
+                       if key not in ("output", "compare", "archive")},
+        },
+        "results": results,
+    }
+
+    for name, result in results.items():
+        print(f"{name:22} {result['per_op_us']:12.2f} us/op  "
+              f"(min {result['min_s']:.4f} с, median {result['median_s']:.4f} с, ops {result['ops']})")
+
+    if args.compare:
+        print()
+        for line in compare(results, args.compare):
+            print(line)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import struct
+import sys
+import time
+from datetime import datetime
+
+# Ответ сервера: длина вывода в байтах, затем сам вывод
+RESPONSE_HEADER = struct.Struct("!I")
+
+
+async def connect(host=None, port=None, unix_path=None):
+    if unix_path:
+        return await asyncio.open_unix_connection(unix_path)
+    return await asyncio.open_connection(host, port)
+
+
+async def send(reader, writer, command):
+    writer.write(command.encode("utf-8") + b"\n")
+    await writer.drain()
+    (length,) = RESPONSE_HEADER.unpack(await reader.readexactly(RESPONSE_HEADER.size))
+    data = await reader.readexactly(length)
+    return data.decode("utf-8", "replace")
+
+
+async def interactive(host, port, unix_path):
+    reader, writer = await connect(host, port, unix_path)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                break
+            try:
+                sys.stdout.write(await send(reader, writer, line.strip()))
+            except asyncio.IncompleteReadError:
+                break
+            sys.stdout.flush()
+    finally:
+        writer.close()
+
+
+async def run_session(host, port, unix_path, commands, requests, latencies):
+    reader, writer = await connect(host, port, unix_path)
+    try:
+        for i in range(requests):
+            start = time.perf_counter()
+            await send(reader, writer, commands[i % len(commands)])
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+async def bench(host, port, unix_path, sessions, requests, commands):
+    # Каждая сессия - отдельное соединение, команды посылаются последовательно
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_session(host, port, unix_path, commands, requests, latencies)
+                           for _ in range(sessions)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "sessions": sessions,
+        "requests": len(latencies),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": statistics.mean(latencies) * 1e3,
+            "p50": percentile(latencies, 0.50) * 1e3,
+            "p95": percentile(latencies, 0.95) * 1e3,
+            "p99": percentile(latencies, 0.99) * 1e3,
+            "max": latencies[-1] * 1e3,
+        },
+    }
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Клиент сервера VFS и нагрузочный тест сессий")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8022)
+    parser.add_argument("--unix", help="путь к Unix-сокету сервера")
+    parser.add_argument("--bench", action="store_true", help="нагрузочный тест вместо интерактивного режима")
+    parser.add_argument("--sessions", type=int, default=10, help="одновременных сессий")
+    parser.add_argument("--requests", type=int, default=1000, help="команд в каждой сессии")
+    parser.add_argument("--command", action="append", default=[],
+                        help="команда для нагрузочного теста (можно указать несколько раз)")
+    parser.add_argument("--output", help="записать результаты в JSON-файл")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if not args.bench:
+        asyncio.run(interactive(args.host, args.port, args.unix))
+        return 0
+
+    commands = args.command or ["pwd", "ls /", "cd /", "tree -L 1 --limit 20"]
+    results = asyncio.run(bench(args.host, args.port, args.unix, args.sessions, args.requests, commands))
+    latency = results["latency_ms"]
+    print(f"Сессий: {results['sessions']}, запросов: {results['requests']}, "
+          f"{results['elapsed_s']:.2f} с, {results['throughput_rps']:.0f} запросов/с")
+    print(f"Задержка, мс: mean {latency['mean']:.3f}, p50 {latency['p50']:.3f}, "
+          f"p95 {latency['p95']:.3f}, p99 {latency['p99']:.3f}, max {latency['max']:.3f}")
+
+    if args.output:
+        report = {
+            "meta": {
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "commands": commands,
+            },
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,38 @@
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Emulator import COMPLETION_LIMIT, VFS, Shell
+
+
+class CompletionTest(unittest.TestCase):
+    def setUp(self):
+        vfs = VFS()
+        for i in range(150):
+            vfs.create_file(f"/d/file{i:03}")
+        self.shell = Shell(vfs=vfs, output=io.StringIO())
+
+    def test_common_prefix_covers_matches_beyond_limit(self):
+        line, candidates = self.shell.complete("ls /d/fi")
+        self.assertEqual(line, "ls /d/file")
+        self.assertEqual(len(candidates), COMPLETION_LIMIT)
+        self.assertEqual(candidates[0], "/d/file000")
+
+    def test_single_match_is_completed(self):
+        line, candidates = self.shell.complete("ls /d/file14")
+        self.assertEqual(line, "ls /d/file14")
+        self.assertEqual(self.shell.complete("ls /d/file149")[0], "ls /d/file149 ")
+
+    def test_command_names_beyond_limit(self):
+        names = [name for name in self.shell.command_names if name.startswith("c")]
+        self.assertGreater(len(names), 1)
+        line, candidates = self.shell.complete("c", limit=1)
+        self.assertEqual(line, os.path.commonprefix(names))
+        self.assertEqual(candidates, names[:1])
+
+
+if __name__ == "__main__":
+    unittest.main()
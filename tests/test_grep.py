@@ -0,0 +1,46 @@
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Emulator import VFS, regex_literals
+
+FILES = {
+    "/x.txt": "x" * 200,
+    "/words.txt": "foo\nbar",
+    "/code.py": "count = 123\nvalue = x{123}\nfoo bar\n",
+}
+
+PATTERNS = ["x{123}", "x{2,5}y?", "a{3}", "foo(?!\\s)", "(?<!\\s)bar", "foo(?=\\s)", "bar\\Z",
+            "\\Afoo", "^bar$", "123", "x\\{123\\}", "foo|bar"]
+
+
+class GrepTest(unittest.TestCase):
+    def setUp(self):
+        self.plain = VFS()
+        self.indexed = VFS(trigrams=True)
+        for vfs in (self.plain, self.indexed):
+            for path, content in FILES.items():
+                vfs.write_file(path, content)
+
+    def expected(self, pattern):
+        regex = re.compile(pattern)
+        return sorted((path, line_num, line) for path, content in FILES.items()
+                      for line_num, line in enumerate(content.split("\n"), 1) if regex.search(line))
+
+    def test_quantifier_digits_are_not_literals(self):
+        self.assertEqual(regex_literals("x{123}"), [])
+        self.assertEqual(regex_literals("abc{2,3}defg"), ["defg"])
+
+    def test_indexed_matches_unindexed(self):
+        for pattern in PATTERNS:
+            with self.subTest(pattern=pattern):
+                expected = self.expected(pattern)
+                self.assertEqual(sorted(self.plain.grep(pattern, "/")), expected)
+                self.assertEqual(sorted(self.indexed.grep(pattern, "/")), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
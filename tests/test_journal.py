@@ -0,0 +1,104 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Emulator import JOURNAL_COPY, VFS, Journal
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def test_replay_after_torn_tail(self):
+        journal_path = self.path("vfs.journal")
+        vfs = VFS(journal_path=journal_path)
+        vfs.create_file("/a.txt", "one")
+        vfs.write_file("/a.txt", "two", append=True)
+        vfs.copy_file("/a.txt", "/b.txt")
+        vfs.write_file("/c.txt", "last")
+        vfs.close()
+        # Сбой посреди последней записи
+        with open(journal_path, 'r+b') as f:
+            f.truncate(os.path.getsize(journal_path) - 3)
+
+        replayed = VFS(journal_path=journal_path)
+        self.assertEqual(replayed.read_file("/a.txt"), "onetwo")
+        self.assertEqual(replayed.read_file("/b.txt"), "onetwo")
+        self.assertFalse(replayed.file_exists("/c.txt"))
+        self.assertEqual(replayed.journal.records, 3)
+
+        # Оборванный хвост отрезан: новые записи читаются после перезапуска
+        replayed.write_file("/d.txt", "after")
+        replayed.close()
+        again = VFS(journal_path=journal_path)
+        self.assertEqual(again.read_file("/d.txt"), "after")
+        self.assertEqual(again.journal.records, 4)
+        again.close()
+
+    def test_replay_after_vfs_load(self):
+        archive = self.path("base.zip")
+        source = VFS()
+        self.assertTrue(source.save_to_zip(archive)[0])
+
+        journal_path = self.path("vfs.journal")
+        vfs = VFS(journal_path=journal_path)
+        vfs.filesystem = {}
+        vfs.load(archive)
+        vfs.copy_file("/config/settings.ini", "/settings.copy")
+        vfs.close()
+
+        replayed = VFS(journal_path=journal_path)
+        self.assertEqual(replayed.read_file("/settings.copy"), source.read_file("/config/settings.ini"))
+        replayed.close()
+
+    def test_save_over_loaded_archive_is_a_checkpoint(self):
+        archive = self.path("work.zip")
+        self.assertTrue(VFS().save_to_zip(archive)[0])
+
+        journal_path = self.path("vfs.journal")
+        vfs = VFS(journal_path=journal_path)
+        vfs.load(archive)
+        vfs.write_file("/log", "x\n", append=True)
+        self.assertTrue(vfs.save_to_zip(archive)[0])
+        vfs.write_file("/log", "y\n", append=True)
+        vfs.close()
+
+        replayed = VFS(journal_path=journal_path)
+        self.assertEqual(replayed.read_file("/log"), "x\ny\n")
+        self.assertEqual(replayed.journal.records, 2)
+        replayed.close()
+
+    def test_failed_copy_tree_is_not_logged(self):
+        journal_path = self.path("vfs.journal")
+        vfs = VFS(journal_path=journal_path)
+        vfs.create_file("/backup", "file")
+        success, message = vfs.copy_tree("/documents", "/backup/documents")
+        self.assertFalse(success)
+        vfs.create_file("/copy/documents/projects", "file")
+        success, message = vfs.copy_tree("/documents", "/copy")
+        self.assertFalse(success)
+        # Копирование с конфликтом не начинается
+        self.assertFalse(vfs.file_exists("/copy/documents/report.txt"))
+        self.assertEqual(vfs.journal.records, 2)
+        vfs.close()
+
+        self.assertEqual(VFS().replay_journal(Journal(journal_path).read())[1], [])
+
+    def test_failed_records_are_reported(self):
+        vfs = VFS()
+        applied, failed = vfs.replay_journal([(JOURNAL_COPY, [b"missing.txt", b"copy.txt"])])
+        self.assertEqual(applied, 0)
+        self.assertEqual(len(failed), 1)
+        number, op_name, path, message = failed[0]
+        self.assertEqual((number, op_name, path), (1, "copy", "/missing.txt"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Emulator import OPAQUE_MARKER, VFS, WHITEOUT_PREFIX
+
+
+def data(content):
+    return content.encode('utf-8') if isinstance(content, str) else bytes(content)
+
+
+def files(vfs):
+    return {path: data(vfs._content(node)) for path, node in vfs._walk() if not node.is_dir()}
+
+
+class OverlayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def test_delta_whiteout_and_opaque_dir(self):
+        base = self.path("base.zip")
+        self.assertTrue(VFS().save_to_zip(base)[0])
+
+        upper = VFS(layers=[base])
+        del upper.filesystem["documents/report.txt"]
+        del upper.filesystem["documents/projects/"]
+        upper.filesystem["documents/projects/"] = None
+        upper.filesystem["documents/projects/new.py"] = "print('new')"
+        upper.write_file("/config/settings.ini", "[settings]")
+        delta = self.path("delta.zip")
+        success, message = upper.save_to_zip(delta, delta=True)
+        self.assertTrue(success, message)
+
+        with zipfile.ZipFile(delta) as zip_ref:
+            names = set(zip_ref.namelist())
+        self.assertIn("documents/" + WHITEOUT_PREFIX + "report.txt", names)
+        self.assertIn("documents/projects/" + OPAQUE_MARKER, names)
+        self.assertNotIn("bin/app.exe", names)
+
+        mounted = VFS(layers=[base, delta])
+        self.assertEqual(files(mounted), files(upper))
+        self.assertFalse(mounted.file_exists("/documents/report.txt"))
+        self.assertEqual(sorted(mounted._lookup("documents/projects").children), ["new.py"])
+        self.assertEqual(mounted.read_file("/config/settings.ini"), "[settings]")
+
+
+if __name__ == "__main__":
+    unittest.main()
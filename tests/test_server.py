@@ -0,0 +1,25 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Emulator import VFS, ShellSession
+
+
+class ShellSessionTest(unittest.TestCase):
+    def test_server_environment_is_not_exposed(self):
+        with mock.patch.dict(os.environ, {"SECRET_TOKEN": "secret"}):
+            session = ShellSession(VFS())
+        self.assertEqual(sorted(session.env), ["DATE", "HOME", "PWD", "USER"])
+        self.assertNotIn("secret", session.run_command("echo $SECRET_TOKEN"))
+
+    def test_host_commands_are_denied(self):
+        session = ShellSession(VFS())
+        self.assertIn("--server-host-commands", session.run_command("savevfs /tmp/out.zip"))
+        self.assertEqual(session.failures, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
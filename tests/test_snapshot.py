@@ -0,0 +1,39 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Emulator import VFS
+
+
+def data(content):
+    return content.encode('utf-8') if isinstance(content, str) else bytes(content)
+
+
+def files(vfs):
+    return {path: data(vfs._content(node)) for path, node in vfs._walk() if not node.is_dir()}
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_save_load_roundtrip(self):
+        vfs = VFS()
+        vfs.write_file("/bin/app.exe", bytes(range(256)))
+        vfs.write_file("/documents/report.txt", "Отчет\n", append=True)
+        vfs.copy_tree("/documents", "/backup")
+        snapshot = os.path.join(self.tmp.name, "vfs.vfsnap")
+        success, message = vfs.save_snapshot(snapshot)
+        self.assertTrue(success, message)
+
+        loaded = VFS(snapshot)
+        self.assertEqual(files(loaded), files(vfs))
+        self.assertTrue(loaded.dir_exists("/temp"))
+
+
+if __name__ == "__main__":
+    unittest.main()
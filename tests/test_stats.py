@@ -0,0 +1,37 @@
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Emulator import VFS, Shell, Stats
+
+
+class TimedReadersTest(unittest.TestCase):
+    def setUp(self):
+        self.output = io.StringIO()
+        self.shell = Shell(vfs=VFS(stats=Stats()), output=self.output)
+
+    def test_time_attributes_streaming_readers(self):
+        for command, operation in (("ls /", "vfs.iter_dir"), ("tree /", "vfs.iter_tree"),
+                                   ("cat /documents/report.txt", "vfs.iter_lines"),
+                                   ("tac /documents/report.txt", "vfs.iter_lines_reversed"),
+                                   ("du /", "vfs.iter_du")):
+            with self.subTest(command=command):
+                self.output.seek(0)
+                self.output.truncate()
+                self.shell.command_reader("time " + command)
+                self.assertIn(f"  {operation}: 1 выз.", self.output.getvalue())
+
+    def test_closed_reader_is_recorded_and_releases_lock(self):
+        vfs = self.shell.vfs
+        lines = vfs.iter_tree("/")
+        next(lines)
+        lines.close()
+        self.assertEqual(vfs.stats.snapshot()["vfs.iter_tree"][0], 1)
+        self.assertTrue(vfs.create_file("/after.txt")[0])
+
+
+if __name__ == "__main__":
+    unittest.main()